@@ -0,0 +1,152 @@
+import pathlib
+import time
+from typing import Any, Callable, Optional
+
+import torch
+from torch.utils.data import DataLoader
+
+from ds.dataset import create_dataloader
+from ds.models import LinearNet
+from ds.runner import BatchRecorder, Runner
+
+# Benchmark configuration
+EPOCH_COUNT = 3
+BATCH_SIZE = 128
+LR = 5e-5
+# Logits training may not trail the old Softmax model by more than this
+ACCURACY_TOLERANCE = 0.005
+
+# Data configuration
+DATA_DIR = "./data/raw"
+TEST_DATA = pathlib.Path(f"{DATA_DIR}/t10k-images-idx3-ubyte.gz")
+TEST_LABELS = pathlib.Path(f"{DATA_DIR}/t10k-labels-idx1-ubyte.gz")
+TRAIN_DATA = pathlib.Path(f"{DATA_DIR}/train-images-idx3-ubyte.gz")
+TRAIN_LABELS = pathlib.Path(f"{DATA_DIR}/train-labels-idx1-ubyte.gz")
+
+LOADERS: dict[str, Callable[[], DataLoader[Any]]] = {
+    "per-sample": lambda: create_dataloader(BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS),
+    "batched": lambda: create_dataloader(
+        BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, batched=True
+    ),
+    "resident": lambda: create_dataloader(
+        BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, resident=True
+    ),
+}
+
+# (accumulation steps, autocast dtype) for the training throughput comparison
+TRAIN_SETTINGS: list[tuple[int, Optional[torch.dtype]]] = [
+    (1, None),
+    (4, None),
+    (1, torch.bfloat16),
+    (4, torch.bfloat16),
+]
+
+
+def main() -> None:
+    benchmark_loaders()
+    benchmark_training()
+    benchmark_compiled()
+    benchmark_logits()
+
+
+def benchmark_loaders() -> None:
+    for name, create in LOADERS.items():
+        start = time.perf_counter()
+        loader = create()
+        setup_time = time.perf_counter() - start
+        epoch_time = min(time_epoch(loader) for _ in range(EPOCH_COUNT))
+        print(f"{name:>12}: setup {setup_time:8.3f}s, data/epoch {epoch_time:8.3f}s")
+
+
+def benchmark_training() -> None:
+    loader = create_dataloader(BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, resident=True)
+    for accumulation_steps, autocast_dtype in TRAIN_SETTINGS:
+        model = LinearNet()
+        optimizer = torch.optim.Adam(model.parameters(), lr=LR)
+        runner = Runner(
+            loader,
+            model,
+            optimizer,
+            show_progress=False,
+            accumulation_steps=accumulation_steps,
+            autocast_dtype=autocast_dtype,
+        )
+        samples_per_second = 0.0
+        for _ in range(EPOCH_COUNT):
+            runner.reset()
+            runner.run("Train Batches", BatchRecorder())
+            samples_per_second = max(samples_per_second, runner.samples_per_second)
+        dtype_name = "float32" if autocast_dtype is None else str(autocast_dtype)
+        print(
+            f"effective batch {BATCH_SIZE * accumulation_steps:>5} "
+            f"({accumulation_steps} x {BATCH_SIZE}), {dtype_name:>14}: "
+            f"{samples_per_second:10.0f} samples/s, "
+            f"train accuracy {runner.avg_accuracy: 0.4f}"
+        )
+
+
+def benchmark_compiled() -> None:
+    loader = create_dataloader(BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, resident=True)
+    for compiled in (False, True):
+        model = LinearNet()
+        optimizer = torch.optim.Adam(model.parameters(), lr=LR)
+        runner = Runner(
+            loader, model, optimizer, show_progress=False, compiled=compiled
+        )
+        runner.run("Warmup", BatchRecorder())  # compilation happens here
+        steps_per_second = 0.0
+        for _ in range(EPOCH_COUNT):
+            runner.reset()
+            runner.run("Train Batches", BatchRecorder())
+            steps_per_second = max(
+                steps_per_second, runner.samples_per_second / BATCH_SIZE
+            )
+        name = "compiled" if compiled else "eager"
+        print(f"{name:>12}: {steps_per_second:10.1f} steps/s")
+
+
+def benchmark_logits() -> None:
+    # return_logits=False reproduces the old Softmax -> CrossEntropyLoss model
+    train_loader = create_dataloader(
+        BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, resident=True
+    )
+    test_loader = create_dataloader(
+        BATCH_SIZE, TEST_DATA, TEST_LABELS, shuffle=False, resident=True
+    )
+    accuracies: dict[bool, float] = {}
+    for return_logits in (False, True):
+        torch.manual_seed(0)
+        model = LinearNet(return_logits=return_logits)
+        optimizer = torch.optim.Adam(model.parameters(), lr=LR)
+        train_runner = Runner(train_loader, model, optimizer, show_progress=False)
+        test_runner = Runner(test_loader, model, show_progress=False)
+        samples_per_second = 0.0
+        for _ in range(EPOCH_COUNT):
+            train_runner.reset()
+            train_runner.run("Train Batches", BatchRecorder())
+            samples_per_second = max(
+                samples_per_second, train_runner.samples_per_second
+            )
+        test_runner.run("Validation Batches", BatchRecorder())
+        accuracies[return_logits] = test_runner.avg_accuracy
+        name = "logits" if return_logits else "softmax"
+        print(
+            f"{name:>12}: {samples_per_second:10.0f} samples/s, "
+            f"test accuracy {test_runner.avg_accuracy: 0.4f} "
+            f"after {EPOCH_COUNT} epochs"
+        )
+    assert accuracies[True] >= accuracies[False] - ACCURACY_TOLERANCE, (
+        f"logits accuracy {accuracies[True]:0.4f} regressed below "
+        f"softmax accuracy {accuracies[False]:0.4f}"
+    )
+
+
+def time_epoch(loader: DataLoader[Any]) -> float:
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
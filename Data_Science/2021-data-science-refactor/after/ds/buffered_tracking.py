@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from numbers import Real
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from ds.tracking import ExperimentTracker, Stage
+
+_STOP = object()
+
+
+class BufferedExperiment:
+    """Wraps an ExperimentTracker so batch metrics cost an array store.
+
+    Batch scalars go into preallocated arrays and are handed to a background
+    writer thread in chunks, when the buffer fills up, when `flush_interval`
+    seconds have passed or on `flush()`. Every other call is queued behind the
+    pending chunk, so the wrapped tracker sees calls in their original order
+    and is only ever touched by the writer thread.
+    """
+
+    def __init__(
+        self,
+        tracker: ExperimentTracker,
+        capacity: int = 4096,
+        flush_interval: float = 5.0,
+    ):
+        self.tracker = tracker
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.stage = Stage.TRAIN
+
+        self._names: list[str] = []
+        self._name_ids: dict[str, int] = {}
+        self._stage_ids = np.empty(capacity, dtype=np.int8)
+        self._metric_ids = np.empty(capacity, dtype=np.int32)
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._steps = np.empty(capacity, dtype=np.int64)
+        self._size = 0
+        self._last_handoff = time.monotonic()
+
+        self._queue: queue.Queue[Any] = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def set_stage(self, stage: Stage):
+        self.stage = stage
+
+    def add_batch_metric(self, name: str, value: float, step: int):
+        metric_id = self._name_ids.get(name)
+        if metric_id is None:
+            metric_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+
+        i = self._size
+        self._stage_ids[i] = self.stage.value
+        self._metric_ids[i] = metric_id
+        self._values[i] = value
+        self._steps[i] = step
+        self._size = i + 1
+
+        if (
+            self._size == self.capacity
+            or time.monotonic() - self._last_handoff >= self.flush_interval
+        ):
+            self._handoff()
+
+    def add_epoch_metric(self, name: str, value: float, step: int):
+        self._call("add_epoch_metric", name, value, step)
+
+    def add_epoch_confusion_matrix(self, matrix: np.ndarray, step: int):
+        self._call("add_epoch_confusion_matrix", matrix, step)
+
+    def add_epoch_timings(self, timings: dict[str, float], step: int):
+        self._call("add_epoch_timings", timings, step)
+
+    def add_hparams(
+        self, hparams: dict[str, Union[str, Real]], metrics: dict[str, Real]
+    ):
+        self._call("add_hparams", hparams, metrics)
+
+    def flush(self):
+        """Hands off pending scalars and blocks until the writer has drained."""
+        self._handoff()
+        self._queue.put(("flush",))
+        self._queue.join()
+        self._raise_writer_error()
+
+    def close(self):
+        self.flush()
+        self._queue.put(_STOP)
+        self._writer.join()
+        if hasattr(self.tracker, "close"):
+            self.tracker.close()
+
+    def _call(self, method: str, *args: Any):
+        self._handoff()
+        self._queue.put(("call", self.stage, method, args))
+        self._raise_writer_error()
+
+    def _handoff(self):
+        size = self._size
+        self._last_handoff = time.monotonic()
+        if size == 0:
+            return
+        chunk = (
+            self._stage_ids[:size].copy(),
+            self._metric_ids[:size].copy(),
+            self._values[:size].copy(),
+            self._steps[:size].copy(),
+        )
+        self._queue.put(("batch", tuple(self._names), chunk))
+        self._size = 0
+
+    def _raise_writer_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("experiment writer thread failed") from error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._write(item)
+            except BaseException as error:  # surfaced on the training thread
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, item: tuple[Any, ...]):
+        kind = item[0]
+        if kind == "batch":
+            names, (stage_ids, metric_ids, values, steps) = item[1], item[2]
+            for stage_id, metric_id, value, step in zip(
+                stage_ids.tolist(), metric_ids.tolist(), values.tolist(), steps.tolist()
+            ):
+                self.tracker.set_stage(Stage(stage_id))
+                self.tracker.add_batch_metric(names[metric_id], value, step)
+        elif kind == "call":
+            stage, method, args = item[1], item[2], item[3]
+            self.tracker.set_stage(stage)
+            getattr(self.tracker, method)(*args)
+        elif kind == "flush" and hasattr(self.tracker, "flush"):
+            self.tracker.flush()
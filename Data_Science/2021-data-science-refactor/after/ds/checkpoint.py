@@ -0,0 +1,105 @@
+import copy
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_PREFIX = "epoch_"
+CHECKPOINT_SUFFIX = ".pt"
+
+
+def checkpoint_dir(log_dir: str) -> Path:
+    return Path(log_dir) / CHECKPOINT_DIR
+
+
+def checkpoint_epoch(path: Path) -> int:
+    return int(path.name[len(CHECKPOINT_PREFIX) : -len(CHECKPOINT_SUFFIX)])
+
+
+def list_checkpoints(log_dir: str) -> list[Path]:
+    """Returns the finished checkpoints of an experiment, oldest first."""
+    paths = checkpoint_dir(log_dir).glob(f"{CHECKPOINT_PREFIX}*{CHECKPOINT_SUFFIX}")
+    return sorted(paths, key=checkpoint_epoch)
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread, keeping the last `keep_last`.
+
+    State is copied on the calling thread, so training can continue while the
+    copy is serialized. Each file is written under a temporary name and then
+    renamed, so a crash never leaves a truncated checkpoint behind.
+    """
+
+    def __init__(self, log_dir: str, keep_last: int = 3):
+        if keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}.")
+        self.log_dir = log_dir
+        self.keep_last = keep_last
+        checkpoint_dir(log_dir).mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[Future[Path]] = None
+
+    def save(
+        self,
+        epoch_id: int,
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        run_counts: dict[str, int],
+    ):
+        state = {
+            "epoch_id": epoch_id,
+            "model": copy.deepcopy(model.state_dict()),
+            "optimizer": copy.deepcopy(optimizer.state_dict()),
+            "run_counts": dict(run_counts),
+            "log_dir": self.log_dir,
+        }
+        self.wait()  # at most one write in flight
+        self._pending = self._executor.submit(self._write, state, epoch_id)
+
+    def wait(self) -> Optional[Path]:
+        if self._pending is None:
+            return None
+        path = self._pending.result()
+        self._pending = None
+        return path
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def _write(self, state: dict[str, Any], epoch_id: int) -> Path:
+        path = checkpoint_dir(self.log_dir) / (
+            f"{CHECKPOINT_PREFIX}{epoch_id}{CHECKPOINT_SUFFIX}"
+        )
+        tmp = path.with_name(f"{path.name}.tmp")
+        with open(tmp, "wb") as fp:
+            torch.save(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+
+        for old in list_checkpoints(self.log_dir)[: -self.keep_last]:
+            old.unlink()
+        return path
+
+
+def load_checkpoint(log_dir: str) -> Optional[dict[str, Any]]:
+    """Loads the latest checkpoint of an experiment directory, if there is one."""
+    checkpoints = list_checkpoints(log_dir)
+    if not checkpoints:
+        return None
+    return torch.load(checkpoints[-1], map_location="cpu")
+
+
+def restore_checkpoint(
+    checkpoint: dict[str, Any],
+    model: torch.nn.Module,
+    optimizer: torch.optim.Optimizer,
+) -> int:
+    """Restores model and optimizer state and returns the next epoch to run."""
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    return checkpoint["epoch_id"] + 1
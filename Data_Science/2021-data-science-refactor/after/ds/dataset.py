@@ -1,23 +1,42 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator, Optional, Sequence, Union
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 
-from ds.load_data import load_image_data, load_label_data
+from ds.load_data import (
+    MemmapHandle,
+    ShardedArray,
+    load_image_data,
+    load_label_data,
+    memmap_handle,
+)
 
+SHARED_ARRAYS = ("data", "targets")
 
-class MNIST(Dataset[Any]):
-    idx: int  # requested data index
-    x: torch.Tensor
-    y: torch.Tensor
 
+class MNIST(Dataset[Any]):
     TRAIN_MAX = 255.0
     TRAIN_NORMALIZED_MEAN = 0.1306604762738429
     TRAIN_NORMALIZED_STDEV = 0.3081078038564622
+    # (x / MAX - MEAN) / STDEV folded into a single x * SCALE + SHIFT
+    NORMALIZE_SCALE = 1.0 / (TRAIN_MAX * TRAIN_NORMALIZED_STDEV)
+    NORMALIZE_SHIFT = -TRAIN_NORMALIZED_MEAN / TRAIN_NORMALIZED_STDEV
 
-    def __init__(self, data: np.ndarray, targets: np.ndarray):
+    def __init__(
+        self,
+        data: Union[np.ndarray, ShardedArray],
+        targets: np.ndarray,
+        resident: bool = False,
+    ):
         if len(data) != len(targets):
             raise ValueError(
                 "data and targets must be the same length. "
@@ -26,47 +45,223 @@ class MNIST(Dataset[Any]):
 
         self.data = data
         self.targets = targets
+        self.shared: dict[str, torch.Tensor] = {}
+        self.resident = resident
+        if resident:
+            # Normalize everything once; batches are then views or gathers
+            self.normalized_data = self.normalize(np.array(data)).contiguous()
+            self.target_tensor = torch.from_numpy(np.asarray(targets, dtype=np.int64))
 
     def __len__(self):
         return len(self.data)
 
-    def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
+    def __getitem__(
+        self, idx: Union[int, slice, Sequence[int]]
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        if isinstance(idx, slice):
+            return self.get_slice(idx)
+        if not isinstance(idx, (int, np.integer)):
+            return self.get_batch(idx)
+        if self.resident:
+            return self.normalized_data[idx], self.target_tensor[idx]
         x = self.get_x(idx)
         y = self.get_y(idx)
         return x, y
 
-    def get_x(self, idx: int):
-        self.idx = idx
-        self.preprocess_x()
-        return self.x
+    def get_x(self, idx: int) -> torch.Tensor:
+        return self.preprocess_x(self.data[idx])
+
+    def preprocess_x(self, raw: np.ndarray) -> torch.Tensor:
+        x = raw.astype(np.float64)
+        x /= self.TRAIN_MAX
+        x -= self.TRAIN_NORMALIZED_MEAN
+        x /= self.TRAIN_NORMALIZED_STDEV
+        return torch.from_numpy(x.astype(np.float32)).unsqueeze(0)
+
+    def get_y(self, idx: int) -> torch.Tensor:
+        return self.preprocess_y(self.targets[idx])
+
+    def preprocess_y(self, raw: np.ndarray) -> torch.Tensor:
+        return torch.tensor(raw, dtype=torch.long)
+
+    def get_batch(self, indices: Sequence[int]) -> tuple[torch.Tensor, torch.Tensor]:
+        idx = np.asarray(indices, dtype=np.int64)
+        if self.resident:
+            idx_tensor = torch.from_numpy(idx)
+            return self.normalized_data[idx_tensor], self.target_tensor[idx_tensor]
+        x = self.normalize(np.asarray(self.data[idx]))
+        y = torch.from_numpy(self.targets[idx].astype(np.int64))
+        return x, y
+
+    def get_slice(self, indices: slice) -> tuple[torch.Tensor, torch.Tensor]:
+        if self.resident:
+            # Zero-copy views into the resident tensors
+            return self.normalized_data[indices], self.target_tensor[indices]
+        return self.get_batch(range(len(self))[indices])
+
+    @classmethod
+    def normalize(cls, raw: np.ndarray) -> torch.Tensor:
+        """Maps uint8 images (N, 28, 28) to normalized float32 (N, 1, 28, 28)."""
+        return torch.add(
+            torch.tensor(cls.NORMALIZE_SHIFT, dtype=torch.float32),
+            torch.from_numpy(raw).unsqueeze(1),
+            alpha=cls.NORMALIZE_SCALE,
+        )
+
+    def share_memory(self) -> "MNIST":
+        """Moves arrays into shared memory so worker processes don't copy them.
+
+        Memory-mapped arrays and sharded datasets are already shared through the
+        page cache and are only reopened by path in each worker; in-memory
+        arrays are copied once into shared tensors that the workers then attach
+        to.
+        """
+        for name in SHARED_ARRAYS:
+            array = getattr(self, name)
+            if (
+                isinstance(array, np.ndarray)
+                and memmap_handle(array) is None
+                and name not in self.shared
+            ):
+                tensor = torch.from_numpy(np.array(array)).share_memory_()
+                self.shared[name] = tensor
+                setattr(self, name, tensor.numpy())
+        if self.resident:
+            self.normalized_data.share_memory_()
+            self.target_tensor.share_memory_()
+        return self
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        for name in SHARED_ARRAYS:
+            if name in self.shared:
+                state[name] = self.shared[name]
+            elif (handle := memmap_handle(state[name])) is not None:
+                state[name] = handle
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        for name in SHARED_ARRAYS:
+            value = state[name]
+            if isinstance(value, MemmapHandle):
+                state[name] = value.open()
+            elif isinstance(value, torch.Tensor):
+                state[name] = value.numpy()
+        self.__dict__.update(state)
 
-    def preprocess_x(self):
-        self.x = self.data[self.idx].copy().astype(np.float64)
-        self.x /= self.TRAIN_MAX
-        self.x -= self.TRAIN_NORMALIZED_MEAN
-        self.x /= self.TRAIN_NORMALIZED_STDEV
-        self.x = self.x.astype(np.float32)
-        self.x = torch.from_numpy(self.x)
-        self.x = self.x.unsqueeze(0)
 
-    def get_y(self, idx: int):
-        self.idx = idx
-        self.preprocess_y()
-        return self.y
+class SliceSampler(Sampler[slice]):
+    """Yields contiguous slice(start, stop) batches in order."""
 
-    def preprocess_y(self):
-        self.y = self.targets[self.idx]
-        self.y = torch.tensor(self.y, dtype=torch.long)
+    def __init__(self, length: int, batch_size: int):
+        self.length = length
+        self.batch_size = batch_size
+
+    def __iter__(self) -> Iterator[slice]:
+        for start in range(0, self.length, self.batch_size):
+            yield slice(start, min(start + self.batch_size, self.length))
+
+    def __len__(self) -> int:
+        return (self.length + self.batch_size - 1) // self.batch_size
+
+
+class ShardShuffleSampler(Sampler[list[int]]):
+    """Shuffles a sharded dataset one shard at a time, yielding index batches.
+
+    Shards are visited in random order and records are shuffled within each
+    shard, so reads stay local to one file while the next shard is prefetched.
+    Batches do not span shards, so the last batch of each shard may be short.
+    """
+
+    def __init__(self, data: ShardedArray, batch_size: int):
+        self.data = data
+        self.batch_size = batch_size
+        order = np.argsort(data.shard_ids, kind="stable")
+        shard_ids, starts = np.unique(data.shard_ids[order], return_index=True)
+        self.shard_ids = shard_ids.tolist()
+        self.groups = np.split(order, starts[1:])
+
+    def __iter__(self) -> Iterator[list[int]]:
+        shard_order = torch.randperm(len(self.groups)).tolist()
+        for position, group_id in enumerate(shard_order):
+            if position + 1 < len(shard_order):
+                self.data.prefetch(self.shard_ids[shard_order[position + 1]])
+            group = self.groups[group_id]
+            idx = group[torch.randperm(len(group)).numpy()]
+            for start in range(0, len(idx), self.batch_size):
+                yield idx[start : start + self.batch_size].tolist()
+
+    def __len__(self) -> int:
+        return sum(
+            (len(group) + self.batch_size - 1) // self.batch_size
+            for group in self.groups
+        )
+
+
+def load_dataset(
+    data_path: Path, label_path: Optional[Path]
+) -> tuple[Union[np.ndarray, ShardedArray], np.ndarray]:
+    # A directory is a sharded dataset, which carries its labels in its index
+    if data_path.is_dir():
+        data = ShardedArray(data_path)
+        return data, data.labels
+    assert label_path is not None, "IDX image files need a label file"
+    return load_image_data(data_path), load_label_data(label_path)
 
 
 def create_dataloader(
-    batch_size: int, data_path: Path, label_path: Path, shuffle: bool = True
+    batch_size: int,
+    data_path: Path,
+    label_path: Optional[Path],
+    shuffle: bool = True,
+    batched: bool = False,
+    resident: bool = False,
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    persistent_workers: bool = False,
+    prefetch_factor: Optional[int] = None,
 ) -> DataLoader[Any]:
-    data = load_image_data(data_path)
-    label_data = load_label_data(label_path)
+    data, label_data = load_dataset(data_path, label_path)
+    dataset = MNIST(data, label_data, resident=resident)
+
+    worker_kwargs: dict[str, Any] = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+    }
+    # DataLoader rejects both options without workers
+    if num_workers > 0:
+        dataset.share_memory()
+        worker_kwargs["persistent_workers"] = persistent_workers
+        if prefetch_factor is not None:
+            worker_kwargs["prefetch_factor"] = prefetch_factor
+
+    if isinstance(data, ShardedArray) and shuffle and not resident:
+        return DataLoader(
+            dataset=dataset,
+            batch_size=None,
+            sampler=ShardShuffleSampler(data, batch_size),
+            **worker_kwargs,
+        )
+    if resident and not shuffle:
+        return DataLoader(
+            dataset=dataset,
+            batch_size=None,
+            sampler=SliceSampler(len(dataset), batch_size),
+            **worker_kwargs,
+        )
+    if batched or resident:
+        # The sampler yields whole index lists and automatic batching is off,
+        # so the dataset builds each (B, 1, 28, 28) batch in one call.
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        return DataLoader(
+            dataset=dataset,
+            batch_size=None,
+            sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+            **worker_kwargs,
+        )
     return DataLoader(
-        dataset=MNIST(data, label_data),
+        dataset=dataset,
         batch_size=batch_size,
         shuffle=shuffle,
-        num_workers=0,
+        **worker_kwargs,
     )
@@ -1,6 +1,12 @@
 import gzip
+import hashlib
+import mmap
+import os
+import shutil
 import struct
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, BinaryIO, Iterable, Iterator, Optional
 
 import numpy as np
 
@@ -13,43 +19,304 @@ ALLOWED_TYPES = {
     "DOUBLE": b"\x0E",
 }
 
+# IDX stores multi-byte values big-endian
+IDX_DTYPES = {
+    ALLOWED_TYPES["UNSIGNED_BYTE"]: np.dtype(np.uint8),
+    ALLOWED_TYPES["SIGNED_BYTE"]: np.dtype(np.int8),
+    ALLOWED_TYPES["SHORT"]: np.dtype(">i2"),
+    ALLOWED_TYPES["INT"]: np.dtype(">i4"),
+    ALLOWED_TYPES["SINGLE"]: np.dtype(">f4"),
+    ALLOWED_TYPES["DOUBLE"]: np.dtype(">f8"),
+}
 
-def load_image_data(file_path: Path) -> np.ndarray:
-    with gzip.open(file_path, "rb") as fp:
-        _ = struct.unpack(">H", fp.read(2))  # dump padding bytes
+# Uncompressed IDX sidecars live here, one per (path, size, mtime) of the .gz
+CACHE_DIR = Path("./data/cache")
+HEADER_SIZE = 4
+DIMENSION_SIZE = 4
+COPY_CHUNK_SIZE = 1 << 20
+STREAM_CHUNK_SIZE = 1024  # records per chunk yielded by iter_idx_chunks
 
-        (data_type,) = struct.unpack(">c", fp.read(1))
-        assert data_type == ALLOWED_TYPES["UNSIGNED_BYTE"]
+# Sharded format: <dir>/shard_00000.bin ... raw records, plus <dir>/index.npz
+SHARD_PREFIX = "shard_"
+SHARD_SUFFIX = ".bin"
+SHARD_INDEX = "index.npz"
+RECORDS_PER_SHARD = 10_000
 
-        number_of_dimensions = ord(struct.unpack(">c", fp.read(1))[0])
-        assert number_of_dimensions == 3
 
-        (num_images,) = struct.unpack(">I", fp.read(4))
-        (num_rows,) = struct.unpack(">I", fp.read(4))
-        (num_cols,) = struct.unpack(">I", fp.read(4))
+def load_image_data(
+    file_path: Path, cache_dir: Optional[Path] = CACHE_DIR
+) -> np.ndarray:
+    data = load_idx_data(file_path, cache_dir=cache_dir)
+    assert data.ndim == 3
+    return data
 
-        raw = fp.read()
-        assert len(raw) == num_images * num_rows * num_cols
 
-    data: np.ndarray = np.frombuffer(raw, dtype=np.dtype(np.uint8).newbyteorder(">"))
-    data = data.reshape((num_images, num_rows, num_cols))
+def load_label_data(
+    file_path: Path, cache_dir: Optional[Path] = CACHE_DIR
+) -> np.ndarray:
+    data = load_idx_data(file_path, cache_dir=cache_dir)
+    assert data.ndim == 1
     return data
 
 
-def load_label_data(file_path: Path) -> np.ndarray:
-    with gzip.open(file_path, "rb") as fp:
-        _ = struct.unpack(">H", fp.read(2))  # dump padding bytes
+def load_idx_data(
+    file_path: Path, cache_dir: Optional[Path] = CACHE_DIR
+) -> np.ndarray:
+    """Loads an IDX file, through a memory-mapped sidecar if cache_dir is set."""
+    if cache_dir is None:
+        with gzip.open(file_path, "rb") as fp:
+            dtype, shape = read_idx_header(fp)
+            data = np.empty(shape, dtype=dtype)
+            read_exactly(fp, memoryview(data).cast("B"))
+        return data
 
-        (data_type,) = struct.unpack(">c", fp.read(1))
-        assert data_type == ALLOWED_TYPES["UNSIGNED_BYTE"]
+    return memmap_idx_file(decompress_to_cache(file_path, cache_dir))
 
-        number_of_dimensions = ord(struct.unpack(">c", fp.read(1))[0])
-        assert number_of_dimensions == 1
 
-        (num_images,) = struct.unpack(">I", fp.read(4))
+def read_idx_header(fp: BinaryIO) -> tuple[np.dtype, tuple[int, ...]]:
+    _ = struct.unpack(">H", fp.read(2))  # dump padding bytes
 
-        raw = fp.read()
-        assert len(raw) == num_images
+    (data_type,) = struct.unpack(">c", fp.read(1))
+    assert data_type in IDX_DTYPES, f"unknown IDX data type {data_type!r}"
 
-    data = np.frombuffer(raw, dtype=np.dtype(np.uint8).newbyteorder(">"))
-    return data
+    number_of_dimensions = ord(struct.unpack(">c", fp.read(1))[0])
+    shape = struct.unpack(
+        f">{number_of_dimensions}I", fp.read(number_of_dimensions * DIMENSION_SIZE)
+    )
+    return IDX_DTYPES[data_type], shape
+
+
+def read_exactly(fp: BinaryIO, buffer: memoryview) -> None:
+    """Fills buffer from fp with readinto, which may return short reads."""
+    filled = 0
+    while filled < len(buffer):
+        count = fp.readinto(buffer[filled:])
+        if not count:
+            raise EOFError(f"expected {len(buffer)} bytes, got {filled}")
+        filled += count
+
+
+def iter_idx_chunks(
+    file_path: Path, chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[np.ndarray]:
+    """Streams an IDX file (gzipped or not) as (n, *record_shape) chunks.
+
+    Records are read with readinto into one preallocated buffer, so memory stays
+    at a single chunk whatever the file size. The buffer is reused: copy a
+    chunk if it has to outlive the next iteration.
+    """
+    opener = gzip.open if file_path.suffix == ".gz" else open
+    with opener(file_path, "rb") as fp:
+        dtype, shape = read_idx_header(fp)
+        buffer = np.empty((chunk_size, *shape[1:]), dtype=dtype)
+        view = memoryview(buffer).cast("B")
+        record_size = len(view) // chunk_size
+
+        remaining = shape[0]
+        while remaining > 0:
+            count = min(chunk_size, remaining)
+            read_exactly(fp, view[: count * record_size])
+            remaining -= count
+            yield buffer[:count]
+
+
+def memmap_idx_file(file_path: Path) -> np.ndarray:
+    with open(file_path, "rb") as fp:
+        dtype, shape = read_idx_header(fp)
+    offset = HEADER_SIZE + len(shape) * DIMENSION_SIZE
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def cache_key(file_path: Path) -> str:
+    stat = file_path.stat()
+    key = f"{file_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def cached_path(file_path: Path, cache_dir: Path = CACHE_DIR) -> Path:
+    # "train-images-idx3-ubyte.gz" -> "train-images-idx3-ubyte.<key>"
+    return cache_dir / f"{file_path.stem}.{cache_key(file_path)}"
+
+
+def decompress_to_cache(file_path: Path, cache_dir: Path = CACHE_DIR) -> Path:
+    target = cached_path(file_path, cache_dir)
+    if target.exists():
+        return target
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Write to a private temp file and rename, so concurrent processes never
+    # observe a partially written sidecar.
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    try:
+        with gzip.open(file_path, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    # Sidecars of earlier versions of the file are never read again. Other
+    # processes' temp files are left alone, they may still be writing.
+    for stale in cache_dir.glob(f"{file_path.stem}.*"):
+        if stale != target and stale.suffix != ".tmp":
+            stale.unlink(missing_ok=True)
+    return target
+
+
+@dataclass(frozen=True)
+class MemmapHandle:
+    """Picklable reference to a file-backed array, reopened on unpickling."""
+
+    filename: str
+    offset: int
+    shape: tuple[int, ...]
+    dtype: str
+
+    def open(self) -> np.ndarray:
+        return np.memmap(
+            self.filename,
+            dtype=np.dtype(self.dtype),
+            mode="r",
+            offset=self.offset,
+            shape=self.shape,
+        )
+
+
+def memmap_handle(array: np.ndarray) -> Optional[MemmapHandle]:
+    # Only whole-file maps qualify; views of a memmap keep the parent's offset
+    if not isinstance(array, np.memmap) or not isinstance(array.base, mmap.mmap):
+        return None
+    return MemmapHandle(
+        filename=str(array.filename),
+        offset=array.offset,
+        shape=array.shape,
+        dtype=array.dtype.str,
+    )
+
+
+def shard_path(directory: Path, shard_id: int) -> Path:
+    return directory / f"{SHARD_PREFIX}{shard_id:05d}{SHARD_SUFFIX}"
+
+
+def write_sharded_dataset(
+    directory: Path,
+    chunks: Iterable[tuple[np.ndarray, np.ndarray]],
+    records_per_shard: int = RECORDS_PER_SHARD,
+) -> None:
+    """Writes (images, labels) chunks as fixed-record uint8 shards plus an index.
+
+    The index holds, per record, its shard, its record offset within that shard
+    and its label. It is written last, and renamed into place, so a directory
+    without an index is an unfinished write.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    shard_ids: list[np.ndarray] = []
+    offsets: list[np.ndarray] = []
+    labels: list[np.ndarray] = []
+    record_shape: tuple[int, ...] = ()
+
+    shard_id, position = -1, records_per_shard
+    fp: Optional[BinaryIO] = None
+    try:
+        for images, chunk_labels in chunks:
+            images = np.ascontiguousarray(images, dtype=np.uint8)
+            record_shape = images.shape[1:]
+            start = 0
+            while start < len(images):
+                if position == records_per_shard:
+                    if fp is not None:
+                        fp.close()
+                    shard_id, position = shard_id + 1, 0
+                    fp = open(shard_path(directory, shard_id), "wb")
+                assert fp is not None
+                count = min(len(images) - start, records_per_shard - position)
+                fp.write(images[start : start + count].tobytes())
+                shard_ids.append(np.full(count, shard_id, dtype=np.int32))
+                offsets.append(np.arange(position, position + count, dtype=np.int64))
+                labels.append(np.asarray(chunk_labels[start : start + count]))
+                position += count
+                start += count
+    finally:
+        if fp is not None:
+            fp.close()
+
+    if not shard_ids:
+        raise ValueError(f"No records to write to {directory}.")
+
+    index = directory / SHARD_INDEX
+    tmp = index.with_suffix(f".{os.getpid()}.tmp.npz")
+    try:
+        with open(tmp, "wb") as fp_index:
+            np.savez(
+                fp_index,
+                shard=np.concatenate(shard_ids),
+                offset=np.concatenate(offsets),
+                label=np.concatenate(labels),
+                record_shape=np.asarray(record_shape, dtype=np.int64),
+            )
+        os.replace(tmp, index)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class ShardedArray:
+    """Read-only (N, *record_shape) uint8 array over a sharded dataset directory.
+
+    Shards are memory-mapped lazily, so any record is one index lookup and one
+    page-cache read away, and the dataset never has to fit in RAM.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        with np.load(self.directory / SHARD_INDEX) as index:
+            self.shard_ids: np.ndarray = index["shard"]
+            self.offsets: np.ndarray = index["offset"]
+            self.labels: np.ndarray = index["label"]
+            self.record_shape = tuple(index["record_shape"].tolist())
+        self.dtype = np.dtype(np.uint8)
+        self.shape = (len(self.shard_ids), *self.record_shape)
+        self.ndim = len(self.shape)
+        self._maps: dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, idx: Any) -> np.ndarray:
+        if isinstance(idx, (int, np.integer)):
+            return self.records(int(self.shard_ids[idx]))[self.offsets[idx]]
+        if isinstance(idx, slice):
+            idx = np.arange(len(self))[idx]
+        idx = np.asarray(idx, dtype=np.int64)
+
+        out = np.empty((len(idx), *self.record_shape), dtype=self.dtype)
+        shard_ids = self.shard_ids[idx]
+        for shard_id in np.unique(shard_ids).tolist():
+            mask = shard_ids == shard_id
+            out[mask] = self.records(shard_id)[self.offsets[idx[mask]]]
+        return out
+
+    def __array__(self, dtype: Optional[np.dtype] = None) -> np.ndarray:
+        data = self[np.arange(len(self))]
+        return data if dtype is None else data.astype(dtype)
+
+    def records(self, shard_id: int) -> np.ndarray:
+        if shard_id not in self._maps:
+            self._maps[shard_id] = np.memmap(
+                shard_path(self.directory, shard_id), dtype=self.dtype, mode="r"
+            )
+        return self._maps[shard_id].reshape(-1, *self.record_shape)
+
+    def prefetch(self, shard_id: int) -> None:
+        """Asks the kernel to start reading a shard ahead of its first access."""
+        mapped = self.records(shard_id).base
+        while mapped is not None and not isinstance(mapped, mmap.mmap):
+            mapped = mapped.base
+        if mapped is not None and hasattr(mmap, "MADV_WILLNEED"):
+            mapped.madvise(mmap.MADV_WILLNEED)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Workers reopen the shards themselves instead of receiving the maps
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
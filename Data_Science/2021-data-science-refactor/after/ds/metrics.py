@@ -1,15 +1,257 @@
-from dataclasses import dataclass, field
+import math
+from typing import Optional, Sequence, Union
 
+import numpy as np
+import torch
 
-@dataclass
-class Metric:
-    values: list[float] = field(default_factory=list)
-    running_total: float = 0.0
-    num_updates: float = 0.0
-    average: float = 0.0
 
-    def update(self, value: float, batch_size: int):
-        self.values.append(value)
+class RingBuffer:
+    """Fixed-capacity float history that overwrites its oldest entries."""
+
+    __slots__ = ("buffer", "size", "position")
+
+    def __init__(self, capacity: int):
+        self.buffer = np.empty(capacity, dtype=np.float64)
+        self.size = 0
+        self.position = 0
+
+    def append(self, value: float):
+        self.buffer[self.position] = value
+        self.position = (self.position + 1) % len(self.buffer)
+        self.size = min(self.size + 1, len(self.buffer))
+
+    def to_array(self) -> np.ndarray:
+        """Returns the stored values, oldest first."""
+        if self.size < len(self.buffer):
+            return self.buffer[: self.size].copy()
+        return np.roll(self.buffer, -self.position)
+
+
+class BaseMetric:
+    __slots__ = ("history",)
+
+    def __init__(self, history: int = 0):
+        # Number of past values to keep; 0 keeps none and memory stays O(1)
+        self.history: Optional[RingBuffer] = RingBuffer(history) if history else None
+
+    @property
+    def values(self) -> np.ndarray:
+        if self.history is None:
+            return np.empty(0, dtype=np.float64)
+        return self.history.to_array()
+
+    def update(self, value: float, batch_size: int = 1):
+        if self.history is not None:
+            self.history.append(value)
+
+
+class Metric(BaseMetric):
+    """Batch-size weighted running mean."""
+
+    __slots__ = ("running_total", "num_updates", "average")
+
+    def __init__(self, history: int = 0):
+        super().__init__(history)
+        self.running_total = 0.0
+        self.num_updates = 0.0
+        self.average = 0.0
+
+    def update(self, value: float, batch_size: int = 1):
+        super().update(value, batch_size)
         self.running_total += value * batch_size
         self.num_updates += batch_size
         self.average = self.running_total / self.num_updates
+
+
+class EMAMetric(BaseMetric):
+    """Exponential moving average, seeded with the first value."""
+
+    __slots__ = ("decay", "average", "num_updates")
+
+    def __init__(self, decay: float = 0.99, history: int = 0):
+        super().__init__(history)
+        self.decay = decay
+        self.average = 0.0
+        self.num_updates = 0
+
+    def update(self, value: float, batch_size: int = 1):
+        super().update(value, batch_size)
+        if self.num_updates == 0:
+            self.average = value
+        else:
+            self.average = self.decay * self.average + (1.0 - self.decay) * value
+        self.num_updates += 1
+
+
+class MinMaxMetric(BaseMetric):
+    __slots__ = ("minimum", "maximum")
+
+    def __init__(self, history: int = 0):
+        super().__init__(history)
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def update(self, value: float, batch_size: int = 1):
+        super().update(value, batch_size)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+
+class VarianceMetric(BaseMetric):
+    """Batch-size weighted mean and variance using Welford's algorithm."""
+
+    __slots__ = ("num_updates", "average", "sum_squared_deviations")
+
+    def __init__(self, history: int = 0):
+        super().__init__(history)
+        self.num_updates = 0.0
+        self.average = 0.0
+        self.sum_squared_deviations = 0.0
+
+    def update(self, value: float, batch_size: int = 1):
+        super().update(value, batch_size)
+        self.num_updates += batch_size
+        delta = value - self.average
+        self.average += delta * batch_size / self.num_updates
+        self.sum_squared_deviations += delta * (value - self.average) * batch_size
+
+    @property
+    def variance(self) -> float:
+        if self.num_updates == 0:
+            return 0.0
+        return self.sum_squared_deviations / self.num_updates
+
+    @property
+    def stdev(self) -> float:
+        return math.sqrt(self.variance)
+
+
+class MetricCollection:
+    """Tracks mean, variance, min, max and EMA for many named metrics at once.
+
+    Each field is a NumPy array with one slot per metric, so a single
+    `update` call is a handful of vectorized operations however many metrics
+    are tracked.
+    """
+
+    __slots__ = (
+        "names",
+        "decay",
+        "num_updates",
+        "average",
+        "sum_squared_deviations",
+        "minimum",
+        "maximum",
+        "ema",
+        "history",
+        "history_position",
+        "history_size",
+    )
+
+    def __init__(self, names: Sequence[str], decay: float = 0.99, history: int = 0):
+        self.names = tuple(names)
+        self.decay = decay
+        size = len(self.names)
+        self.num_updates = 0.0
+        self.average = np.zeros(size)
+        self.sum_squared_deviations = np.zeros(size)
+        self.minimum = np.full(size, np.inf)
+        self.maximum = np.full(size, -np.inf)
+        self.ema = np.zeros(size)
+        # (history, num_metrics) ring buffer, one row per update
+        self.history = np.empty((history, size)) if history else None
+        self.history_position = 0
+        self.history_size = 0
+
+    def update(self, values: Union[Sequence[float], np.ndarray], batch_size: int = 1):
+        values = np.asarray(values, dtype=np.float64)
+        if self.num_updates == 0:
+            self.ema[:] = values
+        else:
+            self.ema *= self.decay
+            self.ema += (1.0 - self.decay) * values
+        self.num_updates += batch_size
+        delta = values - self.average
+        self.average += delta * (batch_size / self.num_updates)
+        self.sum_squared_deviations += delta * (values - self.average) * batch_size
+        np.minimum(self.minimum, values, out=self.minimum)
+        np.maximum(self.maximum, values, out=self.maximum)
+
+        if self.history is not None:
+            self.history[self.history_position] = values
+            self.history_position = (self.history_position + 1) % len(self.history)
+            self.history_size = min(self.history_size + 1, len(self.history))
+
+    @property
+    def variance(self) -> np.ndarray:
+        if self.num_updates == 0:
+            return np.zeros_like(self.average)
+        return self.sum_squared_deviations / self.num_updates
+
+    @property
+    def stdev(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def values(self, name: str) -> np.ndarray:
+        """Returns the stored history of one metric, oldest first."""
+        if self.history is None:
+            return np.empty(0, dtype=np.float64)
+        column = self.history[:, self.names.index(name)]
+        if self.history_size < len(self.history):
+            return column[: self.history_size].copy()
+        return np.roll(column, -self.history_position)
+
+    def averages(self) -> dict[str, float]:
+        return dict(zip(self.names, self.average.tolist()))
+
+
+class ClassificationMetrics:
+    """Accumulates accuracy, loss and a confusion matrix without leaving torch.
+
+    The confusion matrix is a flattened (num_classes ** 2) bincount, so memory
+    stays constant no matter how many batches are seen.
+    """
+
+    def __init__(self, num_classes: int = 10):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.confusion = torch.zeros(self.num_classes**2, dtype=torch.long)
+        self.loss_total = torch.zeros((), dtype=torch.float64)
+        self.num_samples = 0
+
+    @torch.no_grad()
+    def update(
+        self, prediction: torch.Tensor, target: torch.Tensor, loss: torch.Tensor
+    ) -> torch.Tensor:
+        """Adds a batch and returns its accuracy as a 0-d tensor."""
+        if self.confusion.device != target.device:
+            self.confusion = self.confusion.to(target.device)
+            self.loss_total = self.loss_total.to(target.device)
+        batch_size = target.shape[0]
+        predicted = prediction.argmax(dim=1)
+        self.confusion += torch.bincount(
+            target * self.num_classes + predicted, minlength=self.num_classes**2
+        )
+        self.loss_total += loss.detach().to(self.loss_total.dtype) * batch_size
+        self.num_samples += batch_size
+        return (predicted == target).sum() / batch_size
+
+    @property
+    def confusion_matrix(self) -> torch.Tensor:
+        """Counts indexed as [true label, predicted label]."""
+        return self.confusion.view(self.num_classes, self.num_classes)
+
+    @property
+    def accuracy(self) -> float:
+        if self.num_samples == 0:
+            return 0.0
+        return self.confusion_matrix.diagonal().sum().item() / self.num_samples
+
+    @property
+    def average_loss(self) -> float:
+        if self.num_samples == 0:
+            return 0.0
+        return self.loss_total.item() / self.num_samples
+
@@ -1,8 +1,11 @@
+import warnings
+from typing import Any, Callable
+
 import torch
 
 
 class LinearNet(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, return_logits: bool = True):
         super().__init__()
 
         self.network = torch.nn.Sequential(
@@ -10,8 +13,45 @@ class LinearNet(torch.nn.Module):
             torch.nn.Linear(in_features=28 * 28, out_features=32),
             torch.nn.ReLU(),
             torch.nn.Linear(in_features=32, out_features=10),
-            torch.nn.Softmax(dim=1),
         )
+        # CrossEntropyLoss applies log-softmax itself, so training needs logits;
+        # set to False to get class probabilities at inference time.
+        self.return_logits = return_logits
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.network(x)
+        logits = self.network(x)
+        return logits if self.return_logits else torch.softmax(logits, dim=1)
+
+
+class CompiledFunction:
+    """Runs `fn` through torch.compile, falling back to eager execution.
+
+    torch.compile compiles lazily, so a missing backend (e.g. no C++ compiler
+    for inductor on this machine) only shows up on the first call. If that
+    call fails, the eager function is used from then on.
+    """
+
+    def __init__(self, fn: Callable[..., Any], backend: str = "inductor"):
+        self.eager = fn
+        self.compiled = None
+        self.checked = False
+        compile_fn = getattr(torch, "compile", None)
+        if compile_fn is None:
+            warnings.warn("torch.compile is unavailable, running eagerly")
+        else:
+            self.compiled = compile_fn(fn, backend=backend)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        if self.compiled is None:
+            return self.eager(*args, **kwargs)
+        if self.checked:
+            return self.compiled(*args, **kwargs)
+        try:
+            result = self.compiled(*args, **kwargs)
+        except Exception as error:  # compilation errors surface on first call
+            warnings.warn(f"compilation failed, running eagerly: {error}")
+            self.compiled = None
+            return self.eager(*args, **kwargs)
+        self.checked = True
+        return result
+
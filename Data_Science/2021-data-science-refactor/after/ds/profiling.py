@@ -0,0 +1,68 @@
+import time
+from enum import IntEnum
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class Phase(IntEnum):
+    DATA = 0  # waiting on the loader
+    FORWARD = 1
+    LOSS = 2
+    BACKWARD = 3
+    OPTIMIZER = 4  # includes zero_grad
+    METRICS = 5
+    TRACKING = 6
+
+
+class PhaseTimer:
+    """Records per-batch phase durations in a (batches, phases) array.
+
+    `lap(phase)` charges the time since the previous lap to `phase` for the
+    current batch; `next_batch()` moves on to a new row. The array doubles in
+    size when full, so recording stays a few float stores per batch.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.durations = np.zeros((capacity, len(Phase)), dtype=np.float64)
+        self.num_batches = 0
+        self._last = time.perf_counter()
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def lap(self, phase: Phase):
+        now = time.perf_counter()
+        self.durations[self.num_batches, phase] += now - self._last
+        self._last = now
+
+    def next_batch(self):
+        self.num_batches += 1
+        if self.num_batches == len(self.durations):
+            grown = np.zeros((2 * len(self.durations), len(Phase)), dtype=np.float64)
+            grown[: self.num_batches] = self.durations
+            self.durations = grown
+
+    def reset(self):
+        self.durations[: self.num_batches + 1] = 0.0
+        self.num_batches = 0
+
+    def total(self, phase: Phase) -> float:
+        return float(self.durations[: self.num_batches, phase].sum())
+
+    def percentiles(self) -> dict[str, float]:
+        """Per-phase batch duration percentiles in milliseconds.
+
+        Phases that never ran (e.g. backward during validation) are left out.
+        """
+        durations = self.durations[: self.num_batches]
+        if len(durations) == 0:
+            return {}
+        values = np.percentile(durations, PERCENTILES, axis=0) * 1e3
+        return {
+            f"{phase.name.lower()}_p{q}": float(values[i, phase])
+            for phase in Phase
+            if durations[:, phase].any()
+            for i, q in enumerate(PERCENTILES)
+        }
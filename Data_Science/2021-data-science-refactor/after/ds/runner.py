@@ -1,14 +1,23 @@
-from typing import Any, Optional
+import contextlib
+import copy
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
 
 import numpy as np
 import torch
-from sklearn.metrics import accuracy_score
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 
-from ds.metrics import Metric
+from ds.metrics import ClassificationMetrics, MetricCollection
+from ds.models import CompiledFunction
+from ds.profiling import Phase, PhaseTimer
 from ds.tracking import ExperimentTracker, Stage
 
+BATCH_STATS = ("loss", "accuracy")
+BATCH_HISTORY = 1024  # per-batch values kept by Runner.batch_stats
+
 
 class Runner:
     def __init__(
@@ -16,57 +25,283 @@ class Runner:
         loader: DataLoader[Any],
         model: torch.nn.Module,
         optimizer: Optional[torch.optim.Optimizer] = None,
+        show_progress: bool = True,
+        trace_path: Optional[str] = None,
+        accumulation_steps: int = 1,
+        autocast_dtype: Optional[torch.dtype] = None,
+        compiled: bool = False,
     ) -> None:
         self.run_count = 0
+        self.show_progress = show_progress
+        # Write a torch.profiler Chrome trace of each run to this path
+        self.trace_path = trace_path
+        self.timer = PhaseTimer()
+        # Micro-batches whose gradients are summed before each optimizer step
+        self.accumulation_steps = accumulation_steps
+        # e.g. torch.bfloat16 to run forward and loss under autocast
+        self.autocast_dtype = autocast_dtype
+        self.samples_per_second = 0.0
         self.loader = loader
-        self.accuracy_metric = Metric()
+        self.metrics = ClassificationMetrics()
+        # Spread of the per-batch values: mean, variance, min/max, EMA, history
+        self.batch_stats = MetricCollection(BATCH_STATS, history=BATCH_HISTORY)
         self.model = model
         self.optimizer = optimizer
         # Objective (loss) function
         self.compute_loss = torch.nn.CrossEntropyLoss(reduction="mean")
-        self.y_true_batches: list[list[Any]] = []
-        self.y_pred_batches: list[list[Any]] = []
         # Assume Stage based on presence of optimizer
         self.stage = Stage.VAL if optimizer is None else Stage.TRAIN
+        # Compile forward + loss, and the optimizer step, as single units
+        self.compiled = compiled
+        self._forward_loss: Callable[..., Any] = self._eager_forward_loss
+        self._optimizer_step: Optional[Callable[[], Any]] = (
+            optimizer.step if optimizer is not None else None
+        )
+        if compiled:
+            self._forward_loss = CompiledFunction(self._eager_forward_loss)
+            if optimizer is not None:
+                self._optimizer_step = CompiledFunction(optimizer.step)
+
+    @property
+    def avg_accuracy(self) -> float:
+        return self.metrics.accuracy
 
     @property
-    def avg_accuracy(self):
-        return self.accuracy_metric.average
+    def avg_loss(self) -> float:
+        return self.metrics.average_loss
+
+    @property
+    def tracking_time(self) -> float:
+        """Seconds spent in batch-level tracking calls since the last reset."""
+        return self.timer.total(Phase.TRACKING)
 
     def run(self, desc: str, experiment: ExperimentTracker):
+        with self._trace():
+            if self.optimizer is None:
+                self.evaluate(desc, experiment)
+            else:
+                self.train(desc, experiment)
+
+    def train(self, desc: str, experiment: ExperimentTracker):
+        assert self.optimizer is not None
         self.model.train(self.stage is Stage.TRAIN)
+        start = time.perf_counter()
+        num_samples = 0
+
+        self.optimizer.zero_grad(set_to_none=True)
+        pending = 0  # micro-batches accumulated since the last step
 
-        for x, y in tqdm(self.loader, desc=desc, ncols=80):
+        self.timer.start()
+        for x, y in self._batches(desc):
+            self.timer.lap(Phase.DATA)
             loss, batch_accuracy = self._run_single(x, y)
+            num_samples += x.shape[0]
+            self._track_batch(experiment, batch_accuracy)
+
+            # Reverse-mode AutoDiff (backpropagation)
+            (loss / self.accumulation_steps).backward()
+            self.timer.lap(Phase.BACKWARD)
+            pending += 1
+            if pending == self.accumulation_steps:
+                self._step()
+                pending = 0
+            self.timer.lap(Phase.OPTIMIZER)
+            self.timer.next_batch()
+
+        # Don't drop the gradients of a trailing, incomplete accumulation, but
+        # average them over the micro-batches it actually has
+        if pending:
+            self._scale_gradients(self.accumulation_steps / pending)
+            self._step()
+
+        self.samples_per_second = num_samples / (time.perf_counter() - start)
+
+    @torch.inference_mode()
+    def evaluate(self, desc: str, experiment: ExperimentTracker):
+        # No autograd graph is recorded, so the loader can use a larger batch
+        self.model.eval()
+        start = time.perf_counter()
+        num_samples = 0
+
+        self.timer.start()
+        for x, y in self._batches(desc):
+            self.timer.lap(Phase.DATA)
+            _, batch_accuracy = self._run_single(x, y)
+            num_samples += x.shape[0]
+            self._track_batch(experiment, batch_accuracy)
+            self.timer.next_batch()
+
+        self.samples_per_second = num_samples / (time.perf_counter() - start)
 
-            experiment.add_batch_metric("accuracy", batch_accuracy, self.run_count)
+    def _step(self):
+        assert self.optimizer is not None and self._optimizer_step is not None
+        self._optimizer_step()
+        self.optimizer.zero_grad(set_to_none=True)
 
-            if self.optimizer:
-                # Reverse-mode AutoDiff (backpropagation)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+    @torch.no_grad()
+    def _scale_gradients(self, factor: float):
+        assert self.optimizer is not None
+        for group in self.optimizer.param_groups:
+            for param in group["params"]:
+                if param.grad is not None:
+                    param.grad.mul_(factor)
+
+    def _batches(self, desc: str) -> Any:
+        return tqdm(self.loader, desc=desc, ncols=80, disable=not self.show_progress)
+
+    def _trace(self) -> Any:
+        if self.trace_path is None:
+            return contextlib.nullcontext()
+        return torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            on_trace_ready=lambda prof: prof.export_chrome_trace(self.trace_path),
+        )
+
+    def _track_batch(self, experiment: ExperimentTracker, batch_accuracy: float):
+        experiment.add_batch_metric("accuracy", batch_accuracy, self.run_count)
+        self.timer.lap(Phase.TRACKING)
 
     def _run_single(self, x: Any, y: Any):
         self.run_count += 1
-        batch_size: int = x.shape[0]
-        prediction = self.model(x)
-        loss = self.compute_loss(prediction, y)
+        with torch.autocast(
+            device_type=x.device.type,
+            dtype=self.autocast_dtype,
+            enabled=self.autocast_dtype is not None,
+        ):
+            if self.compiled:
+                prediction, loss = self._forward_loss(x, y)
+                self.timer.lap(Phase.FORWARD)  # includes the loss
+            else:
+                prediction = self.model(x)
+                self.timer.lap(Phase.FORWARD)
+                loss = self.compute_loss(prediction, y)
+                self.timer.lap(Phase.LOSS)
 
-        # Compute Batch Validation Metrics
-        y_np = y.detach().numpy()
-        y_prediction_np = np.argmax(prediction.detach().numpy(), axis=1)
-        batch_accuracy: float = accuracy_score(y_np, y_prediction_np)
-        self.accuracy_metric.update(batch_accuracy, batch_size)
-
-        self.y_true_batches += [y_np]
-        self.y_pred_batches += [y_prediction_np]
+        # Compute Batch Metrics, with a single device sync for both values
+        accuracy = self.metrics.update(prediction, y, loss)
+        batch_loss, batch_accuracy = torch.stack(
+            [loss.detach().float(), accuracy.float()]
+        ).tolist()
+        self.batch_stats.update((batch_loss, batch_accuracy), y.shape[0])
+        self.timer.lap(Phase.METRICS)
         return loss, batch_accuracy
 
+    def _eager_forward_loss(
+        self, x: torch.Tensor, y: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        prediction = self.model(x)
+        return prediction, self.compute_loss(prediction, y)
+
     def reset(self):
-        self.accuracy_metric = Metric()
-        self.y_true_batches = []
-        self.y_pred_batches = []
+        self.timer.reset()
+        self.metrics.reset()
+        self.batch_stats = MetricCollection(BATCH_STATS, history=BATCH_HISTORY)
+
+
+@dataclass
+class ValidationResult:
+    epoch_id: int
+    accuracy: float
+    loss: float
+    confusion_matrix: np.ndarray
+    samples_per_second: float
+    tracking_time: float
+    run_count: int
+    timings: dict[str, float]
+    # (name, value, step) batch metrics still to be logged, if any
+    batch_metrics: list[tuple[str, float, int]] = field(default_factory=list)
+
+
+class BatchRecorder:
+    """ExperimentTracker that keeps batch metrics in memory for later replay."""
+
+    def __init__(self):
+        self.stage = Stage.VAL
+        self.batch_metrics: list[tuple[str, float, int]] = []
+
+    def set_stage(self, stage: Stage):
+        self.stage = stage
+
+    def add_batch_metric(self, name: str, value: float, step: int):
+        self.batch_metrics.append((name, value, step))
+
+    def add_epoch_metric(self, name: str, value: float, step: int):
+        pass
+
+    def add_epoch_confusion_matrix(self, matrix: np.ndarray, step: int):
+        pass
+
+    def add_epoch_timings(self, timings: dict[str, float], step: int):
+        pass
+
+
+class BackgroundValidator:
+    """Validates a snapshot of the weights on a worker thread.
+
+    The runner's model is replaced by a private copy, so validation of epoch N
+    can run while the training model moves on to epoch N + 1.
+    """
+
+    def __init__(self, runner: Runner):
+        self.runner = runner
+        self.runner.model = copy.deepcopy(runner.model)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[Future[ValidationResult]] = None
+
+    def submit(self, model: torch.nn.Module, epoch_id: int):
+        # Snapshot on the training thread, before the optimizer touches it again
+        state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        self._pending = self._executor.submit(self._validate, state, epoch_id)
+
+    def _validate(
+        self, state: dict[str, torch.Tensor], epoch_id: int
+    ) -> ValidationResult:
+        self.runner.model.load_state_dict(state)
+        recorder = BatchRecorder()
+        result = validate(self.runner, recorder, epoch_id)
+        result.batch_metrics = recorder.batch_metrics
+        return result
+
+    def collect(self, experiment: ExperimentTracker) -> Optional[ValidationResult]:
+        """Waits for the pending validation, if any, and logs it."""
+        if self._pending is None:
+            return None
+        result = self._pending.result()
+        self._pending = None
+        log_validation(experiment, result)
+        return result
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def validate(
+    runner: Runner, experiment: ExperimentTracker, epoch_id: int
+) -> ValidationResult:
+    runner.reset()
+    runner.run("Validation Batches", experiment)
+    return ValidationResult(
+        epoch_id=epoch_id,
+        accuracy=runner.avg_accuracy,
+        loss=runner.avg_loss,
+        confusion_matrix=runner.metrics.confusion_matrix.cpu().numpy().copy(),
+        samples_per_second=runner.samples_per_second,
+        tracking_time=runner.tracking_time,
+        run_count=runner.run_count,
+        timings=runner.timer.percentiles(),
+    )
+
+
+def log_validation(experiment: ExperimentTracker, result: ValidationResult):
+    experiment.set_stage(Stage.VAL)
+    for name, value, step in result.batch_metrics:
+        experiment.add_batch_metric(name, value, step)
+
+    # Log Validation Epoch Metrics
+    experiment.add_epoch_metric("accuracy", result.accuracy, result.epoch_id)
+    experiment.add_epoch_metric("loss", result.loss, result.epoch_id)
+    experiment.add_epoch_confusion_matrix(result.confusion_matrix, result.epoch_id)
+    experiment.add_epoch_timings(result.timings, result.epoch_id)
 
 
 def run_epoch(
@@ -74,20 +309,29 @@ def run_epoch(
     train_runner: Runner,
     experiment: ExperimentTracker,
     epoch_id: int,
-):
+    validator: Optional[BackgroundValidator] = None,
+) -> Optional[ValidationResult]:
+    """Trains one epoch and returns the validation result that completed.
+
+    Without a validator that is this epoch's. With one, this epoch is only
+    queued for validation and the result of the previous epoch is returned.
+    """
     # Training Loop
     experiment.set_stage(Stage.TRAIN)
     train_runner.run("Train Batches", experiment)
 
     # Log Training Epoch Metrics
     experiment.add_epoch_metric("accuracy", train_runner.avg_accuracy, epoch_id)
+    experiment.add_epoch_metric("loss", train_runner.avg_loss, epoch_id)
+    experiment.add_epoch_timings(train_runner.timer.percentiles(), epoch_id)
+
+    if validator is not None:
+        result = validator.collect(experiment)
+        validator.submit(train_runner.model, epoch_id)
+        return result
 
     # Testing Loop
     experiment.set_stage(Stage.VAL)
-    test_runner.run("Validation Batches", experiment)
-
-    # Log Validation Epoch Metrics
-    experiment.add_epoch_metric("accuracy", test_runner.avg_accuracy, epoch_id)
-    experiment.add_epoch_confusion_matrix(
-        test_runner.y_true_batches, test_runner.y_pred_batches, epoch_id
-    )
+    result = validate(test_runner, experiment, epoch_id)
+    log_validation(experiment, result)
+    return result
@@ -0,0 +1,172 @@
+import multiprocessing
+import statistics
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, MutableMapping, Optional, Sequence
+
+import torch
+
+from ds.buffered_tracking import BufferedExperiment
+from ds.dataset import create_dataloader
+from ds.load_data import load_image_data, load_label_data
+from ds.models import LinearNet
+from ds.runner import Runner, run_epoch
+from ds.tensorboard import TensorboardExperiment
+
+OPTIMIZERS = {
+    "Adam": torch.optim.Adam,
+    "SGD": torch.optim.SGD,
+}
+
+
+@dataclass(frozen=True)
+class TrialConfig:
+    lr: float
+    batch_size: int
+    optimizer: str
+
+    def hparams(self) -> dict[str, Any]:
+        return {
+            "LR": self.lr,
+            "BATCH_SIZE": self.batch_size,
+            "OPTIMIZER": self.optimizer,
+        }
+
+
+@dataclass(frozen=True)
+class SweepSpec:
+    """Settings shared by every trial of a sweep."""
+
+    train_data: Path
+    train_labels: Path
+    test_data: Path
+    test_labels: Path
+    log_path: str
+    epoch_count: int
+    eval_batch_size: int = 1024
+
+
+@dataclass
+class TrialResult:
+    trial_id: int
+    config: TrialConfig
+    log_dir: str
+    best_accuracy: float
+    epochs_run: int
+    stopped_early: bool
+
+
+class MedianStopper:
+    """Median stopping rule shared by all trials through a manager dict.
+
+    After `grace_epochs`, a trial stops when its validation accuracy is below
+    the median of what at least `min_trials` other trials reached at the same
+    epoch.
+    """
+
+    def __init__(
+        self,
+        history: MutableMapping[tuple[int, int], float],
+        grace_epochs: int = 2,
+        min_trials: int = 4,
+    ):
+        self.history = history
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+
+    def should_stop(self, trial_id: int, epoch_id: int, accuracy: float) -> bool:
+        self.history[(trial_id, epoch_id)] = accuracy
+        if epoch_id < self.grace_epochs:
+            return False
+        peers = [
+            value
+            for (other_id, other_epoch), value in self.history.items()
+            if other_epoch == epoch_id and other_id != trial_id
+        ]
+        if len(peers) < self.min_trials:
+            return False
+        return accuracy < statistics.median(peers)
+
+
+def run_trial(
+    trial_id: int,
+    config: TrialConfig,
+    spec: SweepSpec,
+    stopper: Optional[MedianStopper] = None,
+) -> TrialResult:
+    # Many trials share the machine; one intra-op thread each avoids oversubscription
+    torch.set_num_threads(1)
+
+    model = LinearNet()
+    optimizer = OPTIMIZERS[config.optimizer](model.parameters(), lr=config.lr)
+    test_loader = create_dataloader(
+        spec.eval_batch_size,
+        spec.test_data,
+        spec.test_labels,
+        shuffle=False,
+        batched=True,
+    )
+    train_loader = create_dataloader(
+        config.batch_size, spec.train_data, spec.train_labels, batched=True
+    )
+    test_runner = Runner(test_loader, model, show_progress=False)
+    train_runner = Runner(train_loader, model, optimizer, show_progress=False)
+
+    experiment = TensorboardExperiment(log_path=spec.log_path, figure_interval=0)
+    tracker = BufferedExperiment(experiment)
+
+    best_accuracy = 0.0
+    stopped_early = False
+    epoch_id = 0
+    for epoch_id in range(spec.epoch_count):
+        result = run_epoch(test_runner, train_runner, tracker, epoch_id)
+        train_runner.reset()
+        assert result is not None
+        best_accuracy = max(best_accuracy, result.accuracy)
+        if stopper is not None and stopper.should_stop(
+            trial_id, epoch_id, result.accuracy
+        ):
+            stopped_early = True
+            break
+
+    tracker.add_hparams(config.hparams(), {"accuracy": best_accuracy})
+    tracker.close()
+    return TrialResult(
+        trial_id=trial_id,
+        config=config,
+        log_dir=experiment.log_dir.as_posix(),
+        best_accuracy=best_accuracy,
+        epochs_run=epoch_id + 1,
+        stopped_early=stopped_early,
+    )
+
+
+def run_sweep(
+    configs: Sequence[TrialConfig],
+    spec: SweepSpec,
+    max_workers: Optional[int] = None,
+    grace_epochs: int = 2,
+    min_trials: int = 4,
+) -> list[TrialResult]:
+    """Runs every config in its own process and experiment directory."""
+    # Decompress the IDX sidecars once, so every trial only maps them
+    for path in (spec.train_data, spec.test_data):
+        load_image_data(path)
+    for path in (spec.train_labels, spec.test_labels):
+        load_label_data(path)
+
+    context = multiprocessing.get_context("spawn")
+    results: list[TrialResult] = []
+    with context.Manager() as manager:
+        stopper = MedianStopper(manager.dict(), grace_epochs, min_trials)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+            futures = [
+                pool.submit(run_trial, trial_id, config, spec, stopper)
+                for trial_id, config in enumerate(configs)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"[Trial {result.trial_id}] {asdict(result)}")
+                results.append(result)
+    return sorted(results, key=lambda r: r.best_accuracy, reverse=True)
@@ -1,29 +1,55 @@
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from numbers import Real
+from typing import Optional, Union
 
 import numpy as np
-from matplotlib import pyplot as plt
-from sklearn.metrics import ConfusionMatrixDisplay, confusion_matrix
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from sklearn.metrics import ConfusionMatrixDisplay
 from torch.utils.tensorboard import SummaryWriter
 
 from ds.tracking import Stage
 from ds.utils import create_experiment_log_dir
 
+CONFUSION_MATRIX_DIR = "confusion_matrix"
 
-class TensorboardExperiment:
-    def __init__(self, log_path: str, create: bool = True):
 
-        log_dir = create_experiment_log_dir(root=log_path)
+class TensorboardExperiment:
+    def __init__(
+        self,
+        log_path: str,
+        create: bool = True,
+        figure_interval: int = 1,
+        log_dir: Optional[str] = None,
+    ):
+        # An existing log_dir resumes that experiment instead of starting a new one
+        if log_dir is None:
+            log_dir = create_experiment_log_dir(root=log_path)
         self.stage = Stage.TRAIN
         self._validate_log_dir(log_dir, create=create)
+        self.log_dir = Path(log_dir)
+        # Render a confusion matrix figure every N epochs; 0 renders on demand only
+        self.figure_interval = figure_interval
         self._writer = SummaryWriter(log_dir=log_dir)
-        plt.ioff()
+        self._renderer: Optional[ProcessPoolExecutor] = None
+        self._pending_figures: list[tuple[str, int, Future[np.ndarray]]] = []
 
     def set_stage(self, stage: Stage):
         self.stage = stage
 
     def flush(self):
+        self._collect_figures(wait=False)
         self._writer.flush()
 
+    def close(self):
+        self._collect_figures(wait=True)
+        if self._renderer is not None:
+            self._renderer.shutdown()
+            self._renderer = None
+        self._writer.close()
+
     @staticmethod
     def _validate_log_dir(log_dir: str, create: bool = True):
         log_path = Path(log_dir).resolve()
@@ -42,23 +68,63 @@ class TensorboardExperiment:
         tag = f"{self.stage.name}/epoch/{name}"
         self._writer.add_scalar(tag, value, step)
 
-    def add_epoch_confusion_matrix(
-        self, y_true: list[np.array], y_pred: list[np.array], step: int
+    def add_epoch_timings(self, timings: dict[str, float], step: int):
+        for name, value in timings.items():
+            self._writer.add_scalar(f"{self.stage.name}/timing/{name}", value, step)
+
+    def add_epoch_confusion_matrix(self, matrix: np.ndarray, step: int):
+        np.save(self.confusion_matrix_path(self.stage, step), matrix.astype(np.int64))
+        if self.figure_interval and step % self.figure_interval == 0:
+            self.render_confusion_matrix(self.stage, step)
+
+    def add_hparams(
+        self, hparams: dict[str, Union[str, Real]], metrics: dict[str, Real]
     ):
-        y_true, y_pred = self.collapse_batches(y_true, y_pred)
-        fig = self.create_confusion_matrix(y_true, y_pred, step)
-        tag = f"{self.stage.name}/epoch/confusion_matrix"
-        self._writer.add_figure(tag, fig, step)
+        _metrics = self._validate_hparam_metric_keys(metrics)
+        self._writer.add_hparams(hparams, _metrics)
 
     @staticmethod
-    def collapse_batches(
-        y_true: list[np.array], y_pred: list[np.array]
-    ) -> tuple[np.ndarray, np.ndarray]:
-        return np.concatenate(y_true), np.concatenate(y_pred)
-
-    def create_confusion_matrix(
-        self, y_true: list[np.array], y_pred: list[np.array], step: int
-    ) -> plt.Figure:
-        cm = ConfusionMatrixDisplay(confusion_matrix(y_true, y_pred)).plot(cmap="Blues")
-        cm.ax_.set_title(f"{self.stage.name} Epoch: {step}")
-        return cm.figure_
+    def _validate_hparam_metric_keys(metrics: dict[str, Real]) -> dict[str, Real]:
+        prefix = "hparam/"
+        return {
+            name if name.startswith(prefix) else f"{prefix}{name}": value
+            for name, value in metrics.items()
+        }
+
+    def confusion_matrix_path(self, stage: Stage, step: int) -> Path:
+        directory = self.log_dir / CONFUSION_MATRIX_DIR
+        directory.mkdir(exist_ok=True)
+        return directory / f"{stage.name}_{step}.npy"
+
+    def render_confusion_matrix(self, stage: Stage, step: int):
+        """Renders a stored confusion matrix in a separate process."""
+        matrix = np.load(self.confusion_matrix_path(stage, step))
+        if self._renderer is None:
+            self._renderer = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+        future = self._renderer.submit(
+            create_confusion_matrix, matrix, f"{stage.name} Epoch: {step}"
+        )
+        tag = f"{stage.name}/epoch/confusion_matrix"
+        self._pending_figures.append((tag, step, future))
+        self._collect_figures(wait=False)
+
+    def _collect_figures(self, wait: bool):
+        pending = []
+        for tag, step, future in self._pending_figures:
+            if wait or future.done():
+                self._writer.add_image(tag, future.result(), step, dataformats="HWC")
+            else:
+                pending.append((tag, step, future))
+        self._pending_figures = pending
+
+
+def create_confusion_matrix(matrix: np.ndarray, title: str) -> np.ndarray:
+    """Draws the matrix off-screen and returns it as an (H, W, 3) uint8 image."""
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    cm = ConfusionMatrixDisplay(matrix).plot(ax=fig.subplots(), cmap="Blues")
+    cm.ax_.set_title(title)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[..., :3].copy()
@@ -22,7 +22,8 @@ class ExperimentTracker(Protocol):
     def add_epoch_metric(self, name: str, value: float, step: int):
         """Implements logging a epoch-level metric."""
 
-    def add_epoch_confusion_matrix(
-        self, y_true: list[np.array], y_pred: list[np.array], step: int
-    ):
-        """Implements logging a confusion matrix at epoch-level."""
+    def add_epoch_confusion_matrix(self, matrix: np.ndarray, step: int):
+        """Implements logging a [true, predicted] confusion matrix at epoch-level."""
+
+    def add_epoch_timings(self, timings: dict[str, float], step: int):
+        """Implements logging per-phase batch time percentiles (ms) at epoch-level."""
@@ -1,15 +1,52 @@
 import pathlib
+from typing import IO
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; mkdir still keeps runs unique
+    fcntl = None  # type: ignore[assignment]
+
+# Holds the next experiment number, so allocation never scans the runs root
+COUNTER_FILE = ".next_experiment"
 
 
 def create_experiment_log_dir(root: str, parents: bool = True) -> str:
     root_path = pathlib.Path(root).resolve()
-    child = (
-        create_from_missing(root_path)
-        if not root_path.exists()
-        else create_from_existing(root_path)
-    )
-    child.mkdir(parents=parents)
-    return child.as_posix()
+    root_path.mkdir(parents=parents, exist_ok=True)
+    while True:
+        child = root_path / str(next_experiment_number(root_path))
+        try:
+            # mkdir is atomic, so two launches can never get the same child
+            child.mkdir()
+        except FileExistsError:
+            continue
+        return child.as_posix()
+
+
+def next_experiment_number(root: pathlib.Path) -> int:
+    with open(root / COUNTER_FILE, "a+") as fp:
+        lock(fp)
+        try:
+            fp.seek(0)
+            text = fp.read().strip()
+            number = int(text) if text else int(create_from_existing(root).name)
+            fp.seek(0)
+            fp.truncate()
+            fp.write(str(number + 1))
+            fp.flush()
+        finally:
+            unlock(fp)
+    return number
+
+
+def lock(fp: IO[str]) -> None:
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+
+def unlock(fp: IO[str]) -> None:
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
 
 
 def create_from_missing(root: pathlib.Path) -> pathlib.Path:
@@ -17,6 +54,7 @@ def create_from_missing(root: pathlib.Path) -> pathlib.Path:
 
 
 def create_from_existing(root: pathlib.Path) -> pathlib.Path:
+    # Only used to seed the counter for runs roots that predate it
     children = [
         int(c.name) for c in root.glob("*")
         if (c.is_dir() and c.name.isnumeric())
@@ -34,3 +72,4 @@ def is_first_experiment(children: list[int]) -> bool:
 
 def increment_experiment_number(children: list[int]) -> str:
     return str(max(children) + 1)
+
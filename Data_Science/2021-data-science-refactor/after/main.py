@@ -1,19 +1,32 @@
 import pathlib
+from typing import Optional
 
 import torch
 
+from ds.buffered_tracking import BufferedExperiment
+from ds.checkpoint import CheckpointWriter, load_checkpoint, restore_checkpoint
 from ds.dataset import create_dataloader
 from ds.models import LinearNet
-from ds.runner import Runner, run_epoch
+from ds.runner import BackgroundValidator, Runner, ValidationResult, run_epoch
 from ds.tensorboard import TensorboardExperiment
 
 # Hyperparameters
 EPOCH_COUNT = 20
 LR = 5e-5
 BATCH_SIZE = 128
+EVAL_BATCH_SIZE = 1024
+NUM_WORKERS = 2
+# Validate epoch N on a weight snapshot while epoch N + 1 trains
+OVERLAP_VALIDATION = True
 
 # Log configuration
 LOG_PATH = "./runs"
+FIGURE_INTERVAL = 5  # render the confusion matrix figure every N epochs
+
+# Checkpoint configuration
+CHECKPOINT_INTERVAL = 1  # epochs between checkpoints
+CHECKPOINT_KEEP_LAST = 3
+RESUME_LOG_DIR: Optional[str] = None  # e.g. "./runs/3" to resume that experiment
 
 # Data configuration
 DATA_DIR = "./data/raw"
@@ -29,38 +42,111 @@ def main():
     model = LinearNet()
     optimizer = torch.optim.Adam(model.parameters(), lr=LR)
 
+    # Restore the latest checkpoint when resuming
+    checkpoint = None
+    start_epoch = 0
+    if RESUME_LOG_DIR:
+        checkpoint = load_checkpoint(RESUME_LOG_DIR)
+        if checkpoint is None:
+            raise FileNotFoundError(f"No checkpoints to resume in {RESUME_LOG_DIR}.")
+        start_epoch = restore_checkpoint(checkpoint, model, optimizer)
+
     # Create the data loaders
-    test_loader = create_dataloader(BATCH_SIZE, TEST_DATA, TEST_LABELS)
-    train_loader = create_dataloader(BATCH_SIZE, TRAIN_DATA, TRAIN_LABELS, shuffle=True)
+    test_loader = create_dataloader(
+        EVAL_BATCH_SIZE,
+        TEST_DATA,
+        TEST_LABELS,
+        batched=True,
+        num_workers=NUM_WORKERS,
+        persistent_workers=True,
+    )
+    train_loader = create_dataloader(
+        BATCH_SIZE,
+        TRAIN_DATA,
+        TRAIN_LABELS,
+        shuffle=True,
+        batched=True,
+        num_workers=NUM_WORKERS,
+        persistent_workers=True,
+    )
 
     # Create the runners
     test_runner = Runner(test_loader, model)
     train_runner = Runner(train_loader, model, optimizer)
-
-    # Setup the experiment tracker
-    tracker = TensorboardExperiment(log_path=LOG_PATH)
+    run_counts = {"train": 0, "test": 0}
+    if checkpoint is not None:
+        run_counts = checkpoint["run_counts"]
+        train_runner.run_count = run_counts["train"]
+        test_runner.run_count = run_counts["test"]
+    validator = BackgroundValidator(test_runner) if OVERLAP_VALIDATION else None
+
+    # Setup the experiment tracker, reusing the experiment directory on resume
+    experiment = TensorboardExperiment(
+        log_path=LOG_PATH,
+        figure_interval=FIGURE_INTERVAL,
+        log_dir=RESUME_LOG_DIR or None,
+    )
+    tracker = BufferedExperiment(experiment)
+    checkpoints = CheckpointWriter(
+        experiment.log_dir.as_posix(), keep_last=CHECKPOINT_KEEP_LAST
+    )
+
+    # The checkpointed epoch may still have been validating when the run
+    # stopped, so validate it again rather than lose its VAL metrics
+    if validator is not None and checkpoint is not None:
+        validator.submit(model, checkpoint["epoch_id"])
 
     # Run the epochs
-    for epoch_id in range(EPOCH_COUNT):
-        run_epoch(test_runner, train_runner, tracker, epoch_id)
-
-        # Compute Average Epoch Metrics
-        summary = ", ".join(
-            [
-                f"[Epoch: {epoch_id + 1}/{EPOCH_COUNT}]",
-                f"Test Accuracy: {test_runner.avg_accuracy: 0.4f}",
-                f"Train Accuracy: {train_runner.avg_accuracy: 0.4f}",
-            ]
-        )
-        print("\n" + summary + "\n")
-
-        # Reset the runners
+    for epoch_id in range(start_epoch, EPOCH_COUNT):
+        result = run_epoch(test_runner, train_runner, tracker, epoch_id, validator)
+        print_summary(epoch_id, train_runner, result)
+
+        # Only completed validations count towards the resumable step state
+        run_counts["train"] = train_runner.run_count
+        if result is not None:
+            run_counts["test"] = result.run_count
+        if (epoch_id + 1) % CHECKPOINT_INTERVAL == 0:
+            checkpoints.save(epoch_id, model, optimizer, run_counts)
+
+        # Reset the training runner; validation resets its own
         train_runner.reset()
-        test_runner.reset()
 
         # Flush the tracker after every epoch for live updates
         tracker.flush()
 
+    if validator is not None:
+        print_summary(EPOCH_COUNT - 1, None, validator.collect(tracker))
+        validator.close()
+
+    checkpoints.close()
+    tracker.close()
+
+
+def print_summary(
+    epoch_id: int,
+    train_runner: Optional[Runner],
+    result: Optional[ValidationResult],
+):
+    # Compute Average Epoch Metrics
+    parts = [f"[Epoch: {epoch_id + 1}/{EPOCH_COUNT}]"]
+    if result is not None:
+        parts += [
+            f"Test Accuracy (epoch {result.epoch_id + 1}): {result.accuracy: 0.4f}",
+            f"Test Samples/s: {result.samples_per_second: 0.0f}",
+            f"Test Tracking Time: {result.tracking_time: 0.3f}s",
+        ]
+    if train_runner is not None:
+        stats = train_runner.batch_stats
+        loss = stats.names.index("loss")
+        parts += [
+            f"Train Accuracy: {train_runner.avg_accuracy: 0.4f}",
+            f"Train Batch Loss: {stats.average[loss]: 0.4f}"
+            f" (sd {stats.stdev[loss]: 0.4f}, EMA {stats.ema[loss]: 0.4f})",
+            f"Train Samples/s: {train_runner.samples_per_second: 0.0f}",
+            f"Train Tracking Time: {train_runner.tracking_time: 0.3f}s",
+        ]
+    print("\n" + ", ".join(parts) + "\n")
+
 
 if __name__ == "__main__":
     main()
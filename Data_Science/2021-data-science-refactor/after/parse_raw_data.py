@@ -1,13 +1,16 @@
+import io
 import os
 import shutil
 import pathlib
-from typing import Iterable, Tuple
+import tarfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple
 
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
-from ds.load_data import load_image_data, load_label_data
+from ds.load_data import iter_idx_chunks, write_sharded_dataset
 
 RAW_DATA = "./data/raw"
 TEST_DATA_RAW = pathlib.Path(f"{RAW_DATA}/t10k-images-idx3-ubyte.gz")
@@ -19,19 +22,33 @@ PROCESSED_DATA = './data/processed'
 TEST_DIR_PROCESSED = pathlib.Path(f"{PROCESSED_DATA}/test")
 TRAIN_DIR_PROCESSED = pathlib.Path(f"{PROCESSED_DATA}/tain")
 
+# Export configuration
+# 'jpg' (one file per image), 'tar' or 'npz' (shards), or 'bin' (the sharded
+# binary format that ds.dataset.create_dataloader reads directly)
+EXPORT_FORMAT = 'jpg'
+CHUNK_SIZE = 1000  # samples per worker task, and per shard
+MAX_WORKERS = os.cpu_count()
+
+Chunk = Tuple[int, np.ndarray, np.ndarray]  # (first index, images, labels)
+
 
 def main():
-    make_tree(TRAIN_DIR_PROCESSED, reset=True)
-    make_tree(TEST_DIR_PROCESSED, reset=True)
+    export(TRAIN_DIR_PROCESSED, TRAIN_DATA_RAW, TRAIN_LABELS_RAW)
+    export(TEST_DIR_PROCESSED, TEST_DATA_RAW, TEST_LABELS_RAW)
+
 
-    save_dataset_to_png(
-        TRAIN_DIR_PROCESSED, 
-        zip(load_image_data(TRAIN_DATA_RAW), load_label_data(TRAIN_LABELS_RAW))
-    )
-    save_dataset_to_png(
-        TEST_DIR_PROCESSED, 
-        zip(load_image_data(TEST_DATA_RAW), load_label_data(TEST_LABELS_RAW))
-    )
+def export(root: pathlib.Path, data_path: pathlib.Path, label_path: pathlib.Path):
+    chunks = iter_chunks(data_path, label_path)
+    if EXPORT_FORMAT == 'jpg':
+        make_tree(root, reset=True)
+        save_dataset_to_png(root, chunks)
+    elif EXPORT_FORMAT == 'bin':
+        reset_tree(root)
+        write_sharded_dataset(root, ((x, y) for _, x, y in chunks))
+    else:
+        reset_tree(root)
+        root.mkdir(parents=True)
+        save_dataset_to_shards(root, chunks, EXPORT_FORMAT)
 
 
 def make_tree(root: pathlib.Path, reset: bool = False) -> None:
@@ -48,11 +65,72 @@ def reset_tree(root: pathlib.Path) -> None:
     shutil.rmtree(root, ignore_errors=True)
 
 
-def save_dataset_to_png(
-    root: pathlib.Path, array: Iterable[Tuple[np.ndarray, np.ndarray]]
+def iter_chunks(
+    data_path: pathlib.Path, label_path: pathlib.Path, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Chunk]:
+    start = 0
+    for images, labels in zip(
+        iter_idx_chunks(data_path, chunk_size), iter_idx_chunks(label_path, chunk_size)
+    ):
+        # The reader reuses its buffers, and tasks are pickled lazily
+        yield start, images.copy(), labels.copy()
+        start += len(images)
+
+
+def save_dataset_to_png(root: pathlib.Path, chunks: Iterable[Chunk]) -> None:
+    run_in_pool(save_chunk_to_png, root, chunks)
+
+
+def save_dataset_to_shards(
+    root: pathlib.Path, chunks: Iterable[Chunk], shard_format: str
+) -> None:
+    save_chunk = {'tar': save_chunk_to_tar, 'npz': save_chunk_to_npz}[shard_format]
+    run_in_pool(save_chunk, root, chunks)
+
+
+def run_in_pool(
+    save_chunk: Callable[[pathlib.Path, Chunk], int],
+    root: pathlib.Path,
+    chunks: Iterable[Chunk],
 ) -> None:
-    for i, xy in enumerate(tqdm(tuple(array), ncols=80)):
+    max_pending = 2 * (MAX_WORKERS or 1)
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as pool, tqdm(ncols=80) as bar:
+        pending: list[Future[int]] = []
+        for chunk in chunks:
+            # Bound the number of chunks in flight so memory stays flat
+            if len(pending) >= max_pending:
+                bar.update(pending.pop(0).result())
+            pending.append(pool.submit(save_chunk, root, chunk))
+        for future in pending:
+            bar.update(future.result())
+
+
+def save_chunk_to_png(root: pathlib.Path, chunk: Chunk) -> int:
+    start, images, labels = chunk
+    for i, xy in enumerate(zip(images, labels), start=start):
         save_xy_to_png(root, xy, str(i))
+    return len(images)
+
+
+def save_chunk_to_tar(root: pathlib.Path, chunk: Chunk) -> int:
+    start, images, labels = chunk
+    path = root / f'shard_{start:08d}.tar'
+    with tarfile.open(path, 'w') as tar:
+        for i, (x, y) in enumerate(zip(images, labels), start=start):
+            buffer = io.BytesIO()
+            Image.fromarray(x).save(buffer, format='JPEG')
+            info = tarfile.TarInfo(f'{int(y)}/{i}.jpg')
+            info.size = buffer.tell()
+            buffer.seek(0)
+            tar.addfile(info, buffer)
+    return len(images)
+
+
+def save_chunk_to_npz(root: pathlib.Path, chunk: Chunk) -> int:
+    start, images, labels = chunk
+    path = root / f'shard_{start:08d}.npz'
+    np.savez(path, index=np.arange(start, start + len(images)), x=images, y=labels)
+    return len(images)
 
 
 def save_xy_to_png(
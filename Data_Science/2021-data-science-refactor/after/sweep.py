@@ -0,0 +1,61 @@
+import itertools
+import os
+import pathlib
+
+from ds.sweep import SweepSpec, TrialConfig, run_sweep
+
+# Hyperparameter grid
+EPOCH_COUNT = 20
+LRS = [1e-5, 5e-5, 1e-4, 5e-4, 1e-3]
+BATCH_SIZES = [64, 128, 256]
+OPTIMIZERS = ["Adam", "SGD"]
+
+# Sweep configuration
+MAX_WORKERS = os.cpu_count()
+GRACE_EPOCHS = 2  # epochs every trial runs before it can be stopped early
+MIN_TRIALS = 4  # peers needed at an epoch before the median rule applies
+
+# Log configuration
+LOG_PATH = "./runs"
+
+# Data configuration
+DATA_DIR = "./data/raw"
+TEST_DATA = pathlib.Path(f"{DATA_DIR}/t10k-images-idx3-ubyte.gz")
+TEST_LABELS = pathlib.Path(f"{DATA_DIR}/t10k-labels-idx1-ubyte.gz")
+TRAIN_DATA = pathlib.Path(f"{DATA_DIR}/train-images-idx3-ubyte.gz")
+TRAIN_LABELS = pathlib.Path(f"{DATA_DIR}/train-labels-idx1-ubyte.gz")
+
+
+def main():
+    configs = [
+        TrialConfig(lr=lr, batch_size=batch_size, optimizer=optimizer)
+        for lr, batch_size, optimizer in itertools.product(
+            LRS, BATCH_SIZES, OPTIMIZERS
+        )
+    ]
+    spec = SweepSpec(
+        train_data=TRAIN_DATA,
+        train_labels=TRAIN_LABELS,
+        test_data=TEST_DATA,
+        test_labels=TEST_LABELS,
+        log_path=LOG_PATH,
+        epoch_count=EPOCH_COUNT,
+    )
+    results = run_sweep(
+        configs,
+        spec,
+        max_workers=MAX_WORKERS,
+        grace_epochs=GRACE_EPOCHS,
+        min_trials=MIN_TRIALS,
+    )
+
+    print("\nBest trials:")
+    for result in results[:5]:
+        print(
+            f"{result.best_accuracy: 0.4f} {result.config.hparams()} "
+            f"({result.epochs_run} epochs, {result.log_dir})"
+        )
+
+
+if __name__ == "__main__":
+    main()
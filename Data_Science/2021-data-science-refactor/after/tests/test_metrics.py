@@ -0,0 +1,76 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from ds.metrics import (  # noqa: E402
+    EMAMetric,
+    Metric,
+    MetricCollection,
+    MinMaxMetric,
+    RingBuffer,
+    VarianceMetric,
+)
+
+NUM_UPDATES = 50
+CAPACITY = 16
+
+
+@pytest.fixture
+def updates():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(NUM_UPDATES, 2))
+    weights = rng.integers(1, 128, size=NUM_UPDATES)
+    return values, weights
+
+
+def weighted_moments(column, weights):
+    mean = np.average(column, weights=weights)
+    return mean, np.average((column - mean) ** 2, weights=weights)
+
+
+def test_scalar_metrics_match_two_pass(updates):
+    values, weights = updates
+    column = values[:, 0]
+    mean, variance = Metric(), VarianceMetric(history=CAPACITY)
+    minmax = MinMaxMetric()
+    for value, weight in zip(column, weights):
+        for metric in (mean, variance, minmax):
+            metric.update(float(value), int(weight))
+
+    expected_mean, expected_variance = weighted_moments(column, weights)
+    assert np.isclose(mean.average, expected_mean)
+    # Welford's update must match the two-pass result
+    assert np.isclose(variance.average, expected_mean)
+    assert np.isclose(variance.variance, expected_variance)
+    assert (minmax.minimum, minmax.maximum) == (column.min(), column.max())
+    # The ring buffer holds the last CAPACITY values, oldest first
+    assert np.array_equal(variance.values, column[-CAPACITY:])
+
+
+def test_collection_matches_scalar_metrics(updates):
+    values, weights = updates
+    collection = MetricCollection(("a", "b"), decay=0.9, history=CAPACITY)
+    emas = [EMAMetric(decay=0.9) for _ in collection.names]
+    for row, weight in zip(values, weights):
+        collection.update(row, int(weight))
+        for value, ema in zip(row, emas):
+            ema.update(float(value), int(weight))
+
+    for i, (name, ema) in enumerate(zip(collection.names, emas)):
+        column = values[:, i]
+        expected_mean, expected_variance = weighted_moments(column, weights)
+        assert np.isclose(collection.average[i], expected_mean)
+        assert np.isclose(collection.variance[i], expected_variance)
+        assert np.isclose(collection.stdev[i], np.sqrt(expected_variance))
+        assert np.isclose(collection.ema[i], ema.average)
+        assert collection.minimum[i] == column.min()
+        assert collection.maximum[i] == column.max()
+        assert np.array_equal(collection.values(name), column[-CAPACITY:])
+
+
+def test_ring_buffer_before_wrapping():
+    ring = RingBuffer(CAPACITY)
+    for value in (1.0, 2.0, 3.0):
+        ring.append(value)
+    assert np.array_equal(ring.to_array(), [1.0, 2.0, 3.0])
@@ -0,0 +1,23 @@
+import multiprocessing
+import pathlib
+
+from ds.utils import create_experiment_log_dir
+
+NUM_PROCESSES = 32
+NUM_RUNS = 300
+
+
+def test_concurrent_allocation_is_unique_and_consecutive(tmp_path: pathlib.Path):
+    with multiprocessing.Pool(NUM_PROCESSES) as pool:
+        log_dirs = pool.map(
+            create_experiment_log_dir, [str(tmp_path)] * NUM_RUNS, chunksize=1
+        )
+    numbers = sorted(int(pathlib.Path(log_dir).name) for log_dir in log_dirs)
+    assert numbers == list(range(NUM_RUNS))
+
+
+def test_allocation_seeds_counter_from_existing_runs(tmp_path: pathlib.Path):
+    (tmp_path / "0").mkdir()
+    (tmp_path / "4").mkdir()
+    assert pathlib.Path(create_experiment_log_dir(str(tmp_path))).name == "5"
+    assert pathlib.Path(create_experiment_log_dir(str(tmp_path))).name == "6"
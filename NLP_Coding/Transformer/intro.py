@@ -1,22 +1,120 @@
+import random
+from typing import Iterator, Optional, Sequence
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from torch import Tensor
+from torch.utils.data import Sampler
 
 import numpy as np
 import pdb
+import time
+
+ATTENTION_BACKENDS = ("math", "torch", "blocked")
 
-def scaled_dot_product_attention(query: Tensor, key: Tensor, value: Tensor) -> Tensor:
+def scaled_dot_product_attention(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    mask: Optional[Tensor] = None,
+    causal: bool = False,
+    backend: str = "math",
+    block_size: int = 1024,
+) -> Tensor:
     """
-    Q,K,V: (batch_size, seq_length, num_features)
-    QK^T : (batch_size, seq_length, seq_length)
+    Q,K,V: (batch_size, [num_heads,] seq_length, num_features)
+    QK^T : (batch_size, [num_heads,] seq_length, seq_length)
+    mask : boolean, broadcastable to QK^T; True where the query may attend the key
+    causal: query i only attends keys up to i, with the last query aligned to the
+        last key; each backend applies it without building a dense mask if it can
+
+    backend:
+     - "math": materializes the full QK^T score matrix.
+     - "torch": dispatches to torch.nn.functional.scaled_dot_product_attention.
+     - "blocked": online softmax over (block_size x block_size) tiles, so memory
+       grows linearly with the sequence length.
     """
-    # Batch matrix multiplication is only performed over the last two dimensions.
-    temp = query.bmm(key.transpose(1, 2)) # QK^T 
+    q_len, k_len = query.size(-2), key.size(-2)
+    if q_len == 1:
+        causal = False  # a single query is last in line and sees every key
+    if backend == "torch":
+        if causal and (mask is not None or q_len != k_len):
+            # is_causal cannot be combined with attn_mask, and aligns top-left
+            mask, causal = combine_masks(mask, causal_mask(q_len, k_len, query.device)), False
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, is_causal=causal)
+    if backend == "blocked":
+        return blocked_attention(query, key, value, mask, causal, block_size)
+    assert backend == "math", f"unknown attention backend {backend!r}"
+
+    # Matrix multiplication is batched over every dimension but the last two.
+    temp = query.matmul(key.transpose(-2, -1)) # QK^T 
     scale = query.size(-1) ** 0.5
+    if causal:
+        # The scores are already (q_len, k_len), so a dense triangle costs no more
+        mask = combine_masks(mask, causal_mask(q_len, k_len, query.device))
+    if mask is not None:
+        temp = temp.masked_fill(~mask, float("-inf"))
     softmax = F.softmax(temp / scale, dim=-1)
-    return softmax.bmm(value)
+    return softmax.matmul(value)
+
+
+def blocked_attention(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    mask: Optional[Tensor] = None,
+    causal: bool = False,
+    block_size: int = 1024,
+) -> Tensor:
+    """
+    Attention computed one query block against one key block at a time, keeping
+    a running max, softmax denominator and weighted sum per query row
+    (the "online softmax"), so no (seq_length, seq_length) matrix is built.
+    With causal, each tile builds its own piece of the triangle, and tiles
+    entirely above it are skipped.
+    """
+    scale = query.size(-1) ** -0.5
+    q_len, k_len = query.size(-2), key.size(-2)
+    offset = k_len - q_len  # query i may attend keys up to i + offset
+    out = query.new_empty(*query.shape[:-1], value.size(-1))
+    if mask is not None:
+        # A view, so each tile can be sliced out without copying the mask
+        mask = mask.expand(*query.shape[:-1], k_len)
+
+    for q_start in range(0, q_len, block_size):
+        q = query[..., q_start:q_start + block_size, :] * scale
+        # Finite, so rows whose keys are all masked so far never compute inf - inf
+        row_max = q.new_full((*q.shape[:-1], 1), torch.finfo(q.dtype).min)
+        row_sum = q.new_zeros((*q.shape[:-1], 1))
+        acc = q.new_zeros((*q.shape[:-1], value.size(-1)))
+
+        q_end = q_start + q.size(-2)
+        for k_start in range(0, k_len, block_size):
+            if causal and k_start > q_end - 1 + offset:
+                break
+            k = key[..., k_start:k_start + block_size, :]
+            v = value[..., k_start:k_start + block_size, :]
+            scores = q.matmul(k.transpose(-2, -1))
+            if mask is not None:
+                tile = mask[..., q_start:q_end, k_start:k_start + block_size]
+                scores = scores.masked_fill(~tile, float("-inf"))
+            if causal and k_start + k.size(-2) - 1 > q_start + offset:
+                tril = torch.ones(
+                    q.size(-2), k.size(-2), dtype=torch.bool, device=q.device
+                ).tril(diagonal=q_start + offset - k_start)
+                scores = scores.masked_fill(~tril, float("-inf"))
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # Rescale what was accumulated under the previous max
+            correction = torch.exp(row_max - new_max)
+            weights = torch.exp(scores - new_max)
+            row_sum = row_sum * correction + weights.sum(dim=-1, keepdim=True)
+            acc = acc * correction + weights.matmul(v)
+            row_max = new_max
+
+        out[..., q_start:q_end, :] = acc / row_sum
+    return out
 
 
 class AttentionHead(nn.Module):
@@ -30,7 +128,10 @@ class AttentionHead(nn.Module):
         return scaled_dot_product_attention(self.q(query), self.k(key), self.v(value))
 
 
-class MultiHeadAttention(nn.Module):
+class PerHeadMultiHeadAttention(nn.Module):
+    """
+    Reference implementation: one AttentionHead per head, run in a Python loop.
+    """
     def __init__(self, num_heads: int, dim_in: int, dim_q: int, dim_k: int):
         super().__init__()
         self.heads = nn.ModuleList(
@@ -43,6 +144,152 @@ class MultiHeadAttention(nn.Module):
             torch.cat([h(query, key, value) for h in self.heads], dim=-1)
         )
 
+
+class KVCache:
+    """
+    Projected keys and values of one attention layer, (batch, heads, seq, dim).
+
+    static=True holds the keys/values of the first call (cross-attention over a
+    fixed memory). Otherwise each call appends its keys/values (decoder
+    self-attention); storage doubles when full, so a step is one slice write.
+    """
+    def __init__(self, static: bool = False):
+        self.static = static
+        self.keys: Optional[Tensor] = None
+        self.values: Optional[Tensor] = None
+        self.length = 0
+
+    def update(self, k: Tensor, v: Tensor) -> tuple[Tensor, Tensor]:
+        if self.static:
+            self.keys, self.values, self.length = k, v, k.size(-2)
+            return k, v
+        end = self.length + k.size(-2)
+        if self.keys is None or end > self.keys.size(-2):
+            capacity = max(end, 2 * self.length, 16)
+            self.keys = self._grow(self.keys, k, capacity)
+            self.values = self._grow(self.values, v, capacity)
+        self.keys[..., self.length:end, :] = k
+        self.values[..., self.length:end, :] = v
+        self.length = end
+        return self.keys[..., :end, :], self.values[..., :end, :]
+
+    def _grow(self, old: Optional[Tensor], new: Tensor, capacity: int) -> Tensor:
+        grown = new.new_empty(*new.shape[:-2], capacity, new.size(-1))
+        if old is not None:
+            grown[..., :self.length, :] = old[..., :self.length, :]
+        return grown
+
+    def reorder(self, indices: Tensor) -> None:
+        # Beam search: row i of the batch continues from row indices[i]
+        # Only the filled prefix; the spare capacity is regrown on demand
+        if self.keys is not None:
+            self.keys = self.keys[..., :self.length, :].index_select(0, indices)
+            self.values = self.values[..., :self.length, :].index_select(0, indices)
+
+
+class MultiHeadAttention(nn.Module):
+    """
+    All heads at once: Q, K and V of every head come from one packed projection
+    in_proj = [Q_0 .. Q_h | K_0 .. K_h | V_0 .. V_h], reshaped to
+    (batch, heads, seq, dim) for a single batched attention.
+    """
+    def __init__(self, num_heads: int, dim_in: int, dim_q: int, dim_k: int):
+        super().__init__()
+        self.num_heads = num_heads
+        self.dim_q = dim_q
+        self.dim_k = dim_k
+        self.backend = "math"  # see scaled_dot_product_attention
+        self.in_proj = nn.Linear(dim_in, num_heads * (dim_q + 2 * dim_k))
+        self.linear = nn.Linear(num_heads * dim_k, dim_in)
+
+    @classmethod
+    def from_per_head(cls, module: PerHeadMultiHeadAttention) -> "MultiHeadAttention":
+        head = module.heads[0]
+        fused = cls(len(module.heads), head.q.in_features, head.q.out_features, head.k.out_features)
+        fused.load_state_dict(module.state_dict())
+        return fused
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept state dicts saved from the per-head layout
+        if f"{prefix}heads.0.q.weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[f"{prefix}in_proj.{name}"] = torch.cat([
+                    state_dict.pop(f"{prefix}heads.{i}.{proj}.{name}")
+                    for proj in ("q", "k", "v")
+                    for i in range(self.num_heads)
+                ])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        key_padding_mask: Optional[Tensor] = None,
+        causal: bool = False,
+        cache: Optional[KVCache] = None,
+    ) -> Tensor:
+        """
+        key_padding_mask: (batch_size, key_length), True at padding positions
+        causal: query i only attends keys up to i
+        cache: keys/values of earlier calls; key_padding_mask then covers them too
+        """
+        if cache is not None and cache.static and cache.keys is not None:
+            # The memory was projected on the first step
+            q, k, v = self.project_query(query), cache.keys, cache.values
+        else:
+            q, k, v = self.project(query, key, value)
+            if cache is not None:
+                k, v = cache.update(k, v)
+        mask = padding_mask(key_padding_mask) if key_padding_mask is not None else None
+        out = scaled_dot_product_attention(q, k, v, mask, causal, backend=self.backend)
+        batch_size, _, seq_len, _ = out.shape
+        return self.linear(out.transpose(1, 2).reshape(batch_size, seq_len, -1))
+
+    def project(self, query: Tensor, key: Tensor, value: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        size_q, size_k = self.num_heads * self.dim_q, self.num_heads * self.dim_k
+        weight, bias = self.in_proj.weight, self.in_proj.bias
+        if query is key and key is value:
+            # Self-attention: one matmul for Q, K and V of every head
+            q, k, v = self.in_proj(query).split([size_q, size_k, size_k], dim=-1)
+        elif key is value:
+            q = F.linear(query, weight[:size_q], bias[:size_q])
+            k, v = F.linear(key, weight[size_q:], bias[size_q:]).split([size_k, size_k], dim=-1)
+        else:
+            w_q, w_k, w_v = weight.split([size_q, size_k, size_k])
+            b_q, b_k, b_v = bias.split([size_q, size_k, size_k])
+            q, k, v = F.linear(query, w_q, b_q), F.linear(key, w_k, b_k), F.linear(value, w_v, b_v)
+        return self.split_heads(q, self.dim_q), self.split_heads(k, self.dim_k), self.split_heads(v, self.dim_k)
+
+    def project_query(self, query: Tensor) -> Tensor:
+        size_q = self.num_heads * self.dim_q
+        q = F.linear(query, self.in_proj.weight[:size_q], self.in_proj.bias[:size_q])
+        return self.split_heads(q, self.dim_q)
+
+    def split_heads(self, x: Tensor, dim: int) -> Tensor:
+        # (batch, seq, heads * dim) -> (batch, heads, seq, dim)
+        batch_size, seq_len, _ = x.shape
+        return x.view(batch_size, seq_len, self.num_heads, dim).transpose(1, 2)
+
+def causal_mask(q_len: int, k_len: int, device: Optional[torch.device] = None) -> Tensor:
+    # The last query lines up with the last key, so q_len < k_len also works
+    ones = torch.ones(q_len, k_len, dtype=torch.bool, device=device)
+    return ones.tril(diagonal=k_len - q_len)
+
+def padding_mask(key_padding_mask: Tensor) -> Tensor:
+    # (batch_size, k_len), True at padding -> (batch_size, 1, 1, k_len), True to attend
+    return ~key_padding_mask[:, None, None, :]
+
+def combine_masks(mask: Optional[Tensor], other: Tensor) -> Tensor:
+    return other if mask is None else mask & other
+
+def set_attention_backend(model: nn.Module, backend: str) -> nn.Module:
+    assert backend in ATTENTION_BACKENDS, f"unknown attention backend {backend!r}"
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttention):
+            module.backend = backend
+    return model
+
 def position_encoding(seq_len: int, dim_model: int, device: torch.device = torch.device("cpu"),) -> Tensor:
     pos = torch.arange(seq_len, dtype=torch.float, device=device).reshape(1, -1, 1)
     dim = torch.arange(dim_model, dtype=torch.float, device=device).reshape(1, 1, -1)
@@ -50,6 +297,30 @@ def position_encoding(seq_len: int, dim_model: int, device: torch.device = torch
 
     return torch.where(dim.long() % 2 == 0, torch.sin(phase), torch.cos(phase))
 
+class PositionalEncoding(nn.Module):
+    """
+    Adds position_encoding to its input from a table cached in a buffer, so the
+    table follows .to() and is only rebuilt when a longer input shows up (its
+    size then doubles). The table is kept in float32 and each slice is cast to
+    the input's dtype. Returns a new tensor; the input is left untouched.
+    """
+    def __init__(self, dim_model: int, max_len: int = 1024):
+        super().__init__()
+        # Not persistent: it is derived data, and old state dicts lack it
+        self.register_buffer("table", position_encoding(max_len, dim_model), persistent=False)
+
+    def forward(self, x: Tensor, offset: int = 0) -> Tensor:
+        end = offset + x.size(1)
+        if end > self.table.size(1):
+            self.table = position_encoding(
+                max(end, 2 * self.table.size(1)), self.table.size(-1), self.table.device
+            )
+        if self.table.device != x.device:
+            self.table = self.table.to(x.device)
+        # The table stays float32; only the slice is cast, so a low-precision
+        # call never degrades the encodings seen by later calls
+        return x + self.table[:, offset:end].to(x.dtype)
+
 def feed_forward(dim_input: int = 512, dim_feedforward: int = 2048) -> nn.Module:
     return nn.Sequential(
         nn.Linear(dim_input, dim_feedforward),
@@ -64,10 +335,11 @@ class Residual(nn.Module):
         self.norm = nn.LayerNorm(dimension)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, *tensors: Tensor) -> Tensor:
+    def forward(self, *tensors: Tensor, **kwargs) -> Tensor:
         # Assume that the "query" tensor is given first, so we can compute the
-        # residual.  This matches the signature of 'MultiHeadAttention'.
-        return self.norm(tensors[0] + self.dropout(self.sublayer(*tensors)))
+        # residual.  This matches the signature of 'MultiHeadAttention'; keyword
+        # arguments (masks) go to the sublayer untouched.
+        return self.norm(tensors[0] + self.dropout(self.sublayer(*tensors, **kwargs)))
 
 class TransformerEncoderLayer(nn.Module):
     def __init__(
@@ -90,8 +362,8 @@ class TransformerEncoderLayer(nn.Module):
             dropout=dropout,
         )
 
-    def forward(self, src: Tensor) -> Tensor:
-        src = self.attention(src, src, src)
+    def forward(self, src: Tensor, src_key_padding_mask: Optional[Tensor] = None) -> Tensor:
+        src = self.attention(src, src, src, key_padding_mask=src_key_padding_mask)
         return self.feed_forward(src)
 
 
@@ -111,12 +383,12 @@ class TransformerEncoder(nn.Module):
                 for _ in range(num_layers)
             ]
         )
+        self.position_encoding = PositionalEncoding(dim_model)
 
-    def forward(self, src: Tensor) -> Tensor:
-        seq_len, dimension = src.size(1), src.size(2)
-        src += position_encoding(seq_len, dimension)
+    def forward(self, src: Tensor, src_key_padding_mask: Optional[Tensor] = None) -> Tensor:
+        src = self.position_encoding(src)
         for layer in self.layers:
-            src = layer(src)
+            src = layer(src, src_key_padding_mask)
 
         return src
 
@@ -146,9 +418,21 @@ class TransformerDecoderLayer(nn.Module):
             dropout=dropout,
         )
 
-    def forward(self, tgt: Tensor, memory: Tensor) -> Tensor:
-        tgt = self.attention_1(tgt, tgt, tgt)
-        tgt = self.attention_2(tgt, memory, memory)
+    def forward(
+        self,
+        tgt: Tensor,
+        memory: Tensor,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+        memory_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[tuple[KVCache, KVCache]] = None,
+    ) -> Tensor:
+        self_cache, memory_cache = cache if cache is not None else (None, None)
+        tgt = self.attention_1(
+            tgt, tgt, tgt, key_padding_mask=tgt_key_padding_mask, causal=True, cache=self_cache
+        )
+        tgt = self.attention_2(
+            tgt, memory, memory, key_padding_mask=memory_key_padding_mask, cache=memory_cache
+        )
         return self.feed_forward(tgt)
 
 
@@ -168,16 +452,44 @@ class TransformerDecoder(nn.Module):
                 for _ in range(num_layers)
             ]
         )
+        self.position_encoding = PositionalEncoding(dim_model)
         self.linear = nn.Linear(dim_model, dim_model)
 
-    def forward(self, tgt: Tensor, memory: Tensor) -> Tensor:
-        seq_len, dimension = tgt.size(1), tgt.size(2)
-        tgt += position_encoding(seq_len, dimension)
-        for layer in self.layers:
-            tgt = layer(tgt, memory)
+    def forward(
+        self,
+        tgt: Tensor,
+        memory: Tensor,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+        memory_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional["DecoderCache"] = None,
+    ) -> Tensor:
+        """
+        With a cache, tgt holds only the positions after those already decoded.
+        """
+        offset = cache.length if cache is not None else 0
+        tgt = self.position_encoding(tgt, offset)
+        for i, layer in enumerate(self.layers):
+            layer_cache = cache.layers[i] if cache is not None else None
+            tgt = layer(tgt, memory, tgt_key_padding_mask, memory_key_padding_mask, layer_cache)
+        if cache is not None:
+            cache.length += tgt.size(1)
 
         return torch.softmax(self.linear(tgt), dim=-1)
 
+class DecoderCache:
+    """
+    Per decoder layer, the growing self-attention keys/values and the
+    cross-attention keys/values over the memory (computed on the first step).
+    """
+    def __init__(self, num_layers: int):
+        self.layers = [(KVCache(), KVCache(static=True)) for _ in range(num_layers)]
+        self.length = 0
+
+    def reorder(self, indices: Tensor) -> None:
+        # Beams only move within their own source, so the memory caches stay valid
+        for self_cache, _ in self.layers:
+            self_cache.reorder(indices)
+
 class Transformer(nn.Module):
     def __init__(
         self, 
@@ -205,10 +517,293 @@ class Transformer(nn.Module):
             dropout=dropout,
         )
 
-    def forward(self, src: Tensor, tgt: Tensor) -> Tensor:
-        return self.decoder(tgt, self.encoder(src))
+    def forward(
+        self,
+        src: Tensor,
+        tgt: Tensor,
+        src_key_padding_mask: Optional[Tensor] = None,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        memory = self.encoder(src, src_key_padding_mask)
+        return self.decoder(tgt, memory, tgt_key_padding_mask, src_key_padding_mask)
+
+    @torch.no_grad()
+    def generate(
+        self,
+        src: Tensor,
+        embed: nn.Module,
+        start_token: int,
+        max_len: int,
+        beam_size: int = 1,
+        end_token: Optional[int] = None,
+        src_key_padding_mask: Optional[Tensor] = None,
+        use_cache: bool = True,
+    ) -> Tensor:
+        """
+        Beam search over the decoder's output distribution (beam_size=1 is greedy
+        decoding). `embed` maps token ids (batch, seq) to (batch, seq, dim_model).
+        With use_cache, each step runs the decoder on the newest token only;
+        otherwise it reruns the whole prefix, as forward() would.
+
+        Returns the best sequence per source, (batch_size, <= max_len + 1),
+        starting with start_token. Call .eval() first to disable dropout.
+        """
+        batch_size = src.size(0)
+        memory = self.encoder(src, src_key_padding_mask).repeat_interleave(beam_size, dim=0)
+        if src_key_padding_mask is not None:
+            src_key_padding_mask = src_key_padding_mask.repeat_interleave(beam_size, dim=0)
+        cache = DecoderCache(len(self.decoder.layers)) if use_cache else None
+
+        tokens = torch.full(
+            (batch_size * beam_size, 1), start_token, dtype=torch.long, device=src.device
+        )
+        # All beams start out identical, so only the first one may expand
+        scores = torch.full((batch_size, beam_size), float("-inf"), device=src.device)
+        scores[:, 0] = 0.0
+        finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=src.device)
+        offsets = torch.arange(batch_size, device=src.device)[:, None] * beam_size
+
+        for _ in range(max_len):
+            tgt = embed(tokens[:, -1:] if use_cache else tokens)
+            probs = self.decoder(tgt, memory, None, src_key_padding_mask, cache)[:, -1]
+            log_probs = probs.log()
+            if end_token is not None:
+                # A finished beam keeps its score and only extends with end_token
+                log_probs[finished] = float("-inf")
+                log_probs[finished, end_token] = 0.0
+            vocab_size = log_probs.size(-1)
+            candidates = (scores.view(-1, 1) + log_probs).view(batch_size, -1)
+            scores, flat = candidates.topk(beam_size, dim=-1)
+            indices = (flat // vocab_size + offsets).view(-1)
+            next_token = (flat % vocab_size).view(-1, 1)
+
+            tokens = torch.cat([tokens[indices], next_token], dim=1)
+            # Greedy rows never move, so there is nothing to reorder
+            if cache is not None and beam_size > 1:
+                cache.reorder(indices)
+            if end_token is not None:
+                finished = finished[indices] | (next_token[:, 0] == end_token)
+                if finished.all():
+                    break
+
+        best = scores.argmax(dim=-1)
+        return tokens.view(batch_size, beam_size, -1)[torch.arange(batch_size), best]
+
+class BucketBatchSampler(Sampler[list[int]]):
+    """
+    Batches of similar-length sequences: indices are shuffled, cut into pools of
+    `bucket_size` batches, sorted by length inside each pool and then batched, so
+    a batch is only padded to the longest sequence of its own neighbourhood.
+    """
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_size: int = 100,
+        shuffle: bool = True,
+        drop_last: bool = False,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self) -> Iterator[list[int]]:
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=self.lengths.__getitem__)
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            # Otherwise every pool would run from its shortest to its longest batch
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+def pad_batch(sequences: Sequence[Tensor]) -> tuple[Tensor, Tensor]:
+    """
+    Collates (seq_length, dim_model) tensors into a zero-padded
+    (batch_size, max_length, dim_model) batch and its key padding mask.
+    """
+    lengths = torch.tensor([len(seq) for seq in sequences])
+    padded = nn.utils.rnn.pad_sequence(list(sequences), batch_first=True)
+    key_padding_mask = torch.arange(padded.size(1)) >= lengths[:, None]
+    return padded, key_padding_mask
+
+def check_fused_attention(num_heads: int = 8, dim_in: int = 512) -> None:
+    dim_q = dim_k = dim_in // num_heads
+    per_head = PerHeadMultiHeadAttention(num_heads, dim_in, dim_q, dim_k)
+    fused = MultiHeadAttention.from_per_head(per_head)
+    x, memory = torch.rand(4, 32, dim_in), torch.rand(4, 16, dim_in)
+    with torch.no_grad():
+        assert torch.allclose(per_head(x, x, x), fused(x, x, x), atol=1e-5)
+        assert torch.allclose(per_head(x, memory, memory), fused(x, memory, memory), atol=1e-5)
+
+def check_attention_backends() -> None:
+    # Odd lengths so the blocked backend sees partial blocks
+    for shape_q, shape_k in [((2, 37, 16), (2, 53, 16)), ((2, 4, 300, 32), (2, 4, 300, 32))]:
+        query, key, value = torch.rand(shape_q), torch.rand(shape_k), torch.rand(shape_k)
+        # Row 0 is padded on the right; row 1 on the left, which with 300 keys
+        # leaves the first (64 key) tile fully masked for every query
+        k_len = shape_k[-2]
+        positions = torch.arange(k_len)
+        padding = torch.stack([positions >= k_len // 2, positions < k_len // 3])
+        padded = padding_mask(padding)
+        if len(shape_q) == 3:
+            padded = padded.squeeze(1)
+        tril = causal_mask(shape_q[-2], k_len)
+        for mask, causal in [(None, False), (padded, False), (None, True), (padded, True)]:
+            # Reference: the math backend with one dense mask
+            dense = combine_masks(mask, tril) if causal else mask
+            expected = scaled_dot_product_attention(query, key, value, dense)
+            # Queries with no key left to attend (causal + left padding) are
+            # undefined, so only rows with at least one key are compared
+            attended = torch.ones(expected.shape[:-1], dtype=torch.bool)
+            if dense is not None:
+                attended = dense.expand(*expected.shape[:-1], k_len).any(dim=-1)
+            for backend in ATTENTION_BACKENDS:
+                actual = scaled_dot_product_attention(
+                    query, key, value, mask, causal, backend=backend, block_size=64
+                )
+                assert torch.allclose(expected[attended], actual[attended], atol=1e-5), (
+                    backend, mask is not None, causal
+                )
+
+def check_masks(dim_model: int = 64) -> None:
+    model = Transformer(2, 2, dim_model=dim_model, num_heads=4, dim_feedforward=128).eval()
+    src_lengths, tgt_lengths = [7, 12, 3], [5, 9, 2]
+    srcs = [torch.rand(n, dim_model) for n in src_lengths]
+    tgts = [torch.rand(n, dim_model) for n in tgt_lengths]
+    with torch.no_grad():
+        # Padding must not change the result for the real positions
+        src, src_padding = pad_batch(srcs)
+        tgt, tgt_padding = pad_batch(tgts)
+        batched = model(src, tgt, src_padding, tgt_padding)
+        for i, (s, t) in enumerate(zip(srcs, tgts)):
+            alone = model(s[None], t[None])[0]
+            assert torch.allclose(batched[i, :len(t)], alone, atol=1e-5)
+
+        # Nor may the decoder look ahead: changing the last target token only
+        # changes the last output
+        t = tgts[0][None]
+        changed = t.clone()
+        changed[:, -1] = torch.rand(dim_model)
+        out, out_changed = model(srcs[0][None], t), model(srcs[0][None], changed)
+        assert torch.allclose(out[:, :-1], out_changed[:, :-1], atol=1e-5)
+
+def check_position_encoding(dim_model: int = 64) -> None:
+    module = PositionalEncoding(dim_model, max_len=8)
+    x = torch.rand(2, 20, dim_model)
+    original = x.clone()
+    # Longer than the initial table, so it has to grow
+    out = module(x)
+    assert torch.equal(x, original), "input was modified"
+    assert torch.allclose(out, x + position_encoding(20, dim_model))
+    assert torch.allclose(module(x[:, 5:], offset=5), out[:, 5:])
+    assert module(x.double()).dtype == torch.float64
+    # A low-precision call must not round the cached table for later calls
+    assert module(x.bfloat16()).dtype == torch.bfloat16
+    assert torch.equal(module(x), out)
+
+def check_incremental_decoding(dim_model: int = 64) -> None:
+    model = Transformer(2, 2, dim_model=dim_model, num_heads=4, dim_feedforward=128).eval()
+    src, tgt = torch.rand(3, 11, dim_model), torch.rand(3, 9, dim_model)
+    with torch.no_grad():
+        memory = model.encoder(src)
+        full = model.decoder(tgt, memory)
+        cache = DecoderCache(len(model.decoder.layers))
+        # One token, then a chunk of several: both must match the full pass
+        chunks = [(0, 1), (1, 5)] + [(t, t + 1) for t in range(5, 9)]
+        steps = [model.decoder(tgt[:, i:j], memory, cache=cache) for i, j in chunks]
+        assert torch.allclose(full, torch.cat(steps, dim=1), atol=1e-5)
+
+    embed = nn.Embedding(dim_model, dim_model)
+    for beam_size in (1, 4):
+        cached = model.generate(src, embed, 0, max_len=12, beam_size=beam_size, end_token=1)
+        recomputed = model.generate(
+            src, embed, 0, max_len=12, beam_size=beam_size, end_token=1, use_cache=False
+        )
+        assert torch.equal(cached, recomputed), beam_size
+
+def benchmark_generation(max_len: int = 128, batch_size: int = 16, dim_model: int = 256) -> None:
+    model = Transformer(3, 3, dim_model=dim_model, num_heads=4, dim_feedforward=1024).eval()
+    embed = nn.Embedding(dim_model, dim_model)
+    src = torch.rand(batch_size, 64, dim_model)
+    for beam_size in (1, 4):
+        for use_cache in (False, True):
+            start = time.perf_counter()
+            tokens = model.generate(src, embed, 0, max_len, beam_size=beam_size, use_cache=use_cache)
+            elapsed = time.perf_counter() - start
+            generated = batch_size * (tokens.size(1) - 1)
+            print(f"beam={beam_size} {'cached' if use_cache else 'recompute':>9}: "
+                  f"{generated / elapsed:8.1f} tokens/s")
+
+def padding_fraction(lengths: Sequence[int], batches: Sequence[list[int]]) -> float:
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return 1 - sum(lengths) / padded
+
+def benchmark_bucketing(batch_size: int = 32, dim_model: int = 128) -> None:
+    lengths = [random.randint(4, 256) for _ in range(2048)]
+    sequences = [torch.rand(n, dim_model) for n in lengths]
+    encoder = TransformerEncoder(2, dim_model, num_heads=4, dim_feedforward=256).eval()
+    for name, sampler in [
+        ("random", BucketBatchSampler(lengths, batch_size, bucket_size=1)),
+        ("bucketed", BucketBatchSampler(lengths, batch_size)),
+    ]:
+        batches = list(sampler)
+        start = time.perf_counter()
+        with torch.no_grad():
+            for batch in batches:
+                encoder(*pad_batch([sequences[i] for i in batch]))
+        print(f"{name:>8}: {padding_fraction(lengths, batches):5.1%} padding, "
+              f"{time.perf_counter() - start:6.2f} s per epoch")
+
+def time_forward(module: nn.Module, x: Tensor, repeat: int = 20) -> float:
+    with torch.no_grad():
+        module(x, x, x)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            module(x, x, x)
+    return (time.perf_counter() - start) / repeat
+
+def benchmark_attention(head_counts=(1, 2, 4, 8, 16), dim_in: int = 512) -> None:
+    x = torch.rand(64, 128, dim_in)
+    for num_heads in head_counts:
+        dim_q = dim_k = dim_in // num_heads
+        per_head = PerHeadMultiHeadAttention(num_heads, dim_in, dim_q, dim_k)
+        fused = MultiHeadAttention.from_per_head(per_head)
+        loop_time, fused_time = time_forward(per_head, x), time_forward(fused, x)
+        print(f"heads={num_heads:>2}: per-head {loop_time * 1e3:7.2f} ms, "
+              f"fused {fused_time * 1e3:7.2f} ms, speedup {loop_time / fused_time:4.2f}x")
+
+
+if __name__ == "__main__":
+    src = torch.rand(64, 32, 512)
+    tgt = torch.rand(64, 16, 512)
+    out = Transformer()(src, tgt)
+    print(out.shape)
+
+    check_fused_attention()
+    check_attention_backends()
+    check_masks()
+    check_position_encoding()
+    check_incremental_decoding()
+    benchmark_attention()
+    benchmark_bucketing()
+    benchmark_generation()
 
-src = torch.rand(64, 32, 512)
-tgt = torch.rand(64, 16, 512)
-out = Transformer()(src, tgt)
-print(out.shape)
+    # Several thousand tokens without a (seq, seq) score matrix per head
+    long_src = torch.rand(1, 8192, 512)
+    encoder = set_attention_backend(TransformerEncoder(num_layers=1), "blocked")
+    with torch.no_grad():
+        print(encoder(long_src).shape)